@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time to save and restore checkpoints of 10k apis::
+
+    python benchmarks/bench_checkpoint.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, '.')
+
+from doctor import HealthTester, Configs  # noqa
+from doctor.checker import MODE_LOCKED  # noqa
+from doctor.checkpoint import Checkpoint  # noqa
+
+
+APIS = 10000
+
+
+def main():
+    tester = HealthTester(Configs())
+    for i in range(APIS):
+        api = tester.metrics.api('svc', 'func{0}'.format(i))
+        api.record('ok')
+        api.record('sys_exc')
+        if i % 10 == 0:
+            lock = tester._get_api_lock(api.key)
+            lock['locked_status'] = MODE_LOCKED
+            lock['locked_at'] = time.time()
+
+    path = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+    start = time.time()
+    Checkpoint(tester, path).save()
+    print('save    {0:8.2f}ms  {1} bytes'.format(
+        (time.time() - start) * 1000, os.path.getsize(path)))
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    checkpoint = Checkpoint(HealthTester(Configs()), path)
+    start = time.time()
+    checkpoint.loads(data)
+    print('restore {0:8.2f}ms  {1} apis'.format(
+        (time.time() - start) * 1000, APIS))
+
+
+if __name__ == '__main__':
+    main()
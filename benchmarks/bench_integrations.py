@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Overhead of the integrations against unwrapped baselines, in microseconds
+per call::
+
+    python benchmarks/bench_integrations.py
+"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+sys.path.insert(0, '.')
+
+from doctor import HealthTester, Configs  # noqa
+from doctor.plugins.client import api_call  # noqa
+from doctor.plugins.wsgi import DoctorMiddleware  # noqa
+
+
+NUMBER = 100000
+
+
+def bench(name, func, baseline):
+    cost = min(timeit.repeat(func, number=NUMBER, repeat=3))
+    base = min(timeit.repeat(baseline, number=NUMBER, repeat=3))
+    print('{0:<16} baseline {1:7.3f}us  wrapped {2:7.3f}us  '
+          'overhead {3:7.3f}us'.format(name, base / NUMBER * 1e6,
+                                       cost / NUMBER * 1e6,
+                                       (cost - base) / NUMBER * 1e6))
+
+
+def bench_client(tester):
+    def hello():
+        return 'hello'
+
+    wrapped = api_call(tester, 'svc')(hello)
+    bench('client', wrapped, hello)
+
+
+def bench_wsgi(tester):
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return [b'hello']
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/hello'}
+    middleware = DoctorMiddleware(app, tester, 'svc',
+                                  lambda environ: 'hello')
+    bench('wsgi', lambda: middleware(environ, start_response),
+          lambda: app(environ, start_response))
+
+
+def bench_asgi(tester):
+    import asyncio
+    from doctor.plugins.asgi import DoctorASGIMiddleware
+
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200})
+
+    async def send(message):
+        pass
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/hello'}
+    middleware = DoctorASGIMiddleware(app, tester, 'svc',
+                                      lambda scope: 'hello')
+
+    async def run(app):
+        for i in range(NUMBER):
+            await app(scope, None, send)
+
+    loop = asyncio.new_event_loop()
+    cost = min(timeit.repeat(lambda: loop.run_until_complete(run(middleware)),
+                             number=1, repeat=3))
+    base = min(timeit.repeat(lambda: loop.run_until_complete(run(app)),
+                             number=1, repeat=3))
+    loop.close()
+    print('{0:<16} baseline {1:7.3f}us  wrapped {2:7.3f}us  '
+          'overhead {3:7.3f}us'.format('asgi', base / NUMBER * 1e6,
+                                       cost / NUMBER * 1e6,
+                                       (cost - base) / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    tester = HealthTester(Configs())
+    bench_client(tester)
+    bench_wsgi(tester)
+    if sys.version_info >= (3, 5):
+        bench_asgi(tester)
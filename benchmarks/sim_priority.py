@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Simulate an api recovering from a lock, with and without request
+priorities, and compare the success rate of each priority at equal backend
+load (the admitted requests)::
+
+    python benchmarks/sim_priority.py
+"""
+
+from __future__ import print_function
+
+import sys
+import random
+
+import mock
+
+sys.path.insert(0, '.')
+
+from doctor import HealthTester, Configs  # noqa
+from doctor.checker import MODE_RECOVER  # noqa
+
+
+# (priority, share of traffic)
+TRAFFIC = [('critical', 0.1), (None, 0.3), ('sheddable', 0.6)]
+WEIGHTS = {'critical': 8.0, 'sheddable': 0.25}
+REQUESTS_PER_SEC = 100
+
+
+def simulate(weights, seed=1, seconds=60):
+    configs = Configs({'METRICS_GRANULARITY': 1,
+                       'METRICS_ROLLINGSIZE': 10,
+                       'HEALTH_MAX_RECOVERY_TIME': seconds,
+                       'HEALTH_PRIORITY_WEIGHTS': weights})
+    rand = random.Random(seed)
+    clock = [1000.0]
+    stats = dict((priority, [0, 0]) for priority, _ in TRAFFIC)
+    with mock.patch('time.time', lambda: clock[0]), \
+            mock.patch('random.random', rand.random):
+        tester = HealthTester(configs)
+        lock = tester._get_api_lock('svc.api')
+        lock['locked_status'] = MODE_RECOVER
+        lock['locked_at'] = clock[0]
+        tester.metrics.on_api_called_ok('svc', 'api')
+        # stop before unlocked, when all requests pass.
+        for i in range((seconds - 1) * REQUESTS_PER_SEC):
+            clock[0] += 1.0 / REQUESTS_PER_SEC
+            r = rand.random()
+            for priority, share in TRAFFIC:
+                r -= share
+                if r < 0:
+                    break
+            stats[priority][1] += 1
+            if tester.test('svc', 'api', priority=priority):
+                stats[priority][0] += 1
+                tester.metrics.on_api_called('svc', 'api')
+                tester.metrics.on_api_called_ok('svc', 'api')
+    return stats
+
+
+def report(name, stats):
+    admitted = sum(s[0] for s in stats.values())
+    print('{0:<16} load {1:6d}  '.format(name, admitted) + '  '.join(
+        '{0}: {1:5.1%}'.format(priority or 'default',
+                               float(ok) / total)
+        for priority, (ok, total) in sorted(stats.items(),
+                                            key=lambda i: str(i[0]))))
+
+
+if __name__ == '__main__':
+    report('no priorities', simulate({}))
+    report('priorities', simulate(WEIGHTS))
@@ -5,6 +5,7 @@ from __future__ import absolute_import
 from .configs import Configs
 from .metrics import Metrics
 from .checker import HealthTester
+from .classifier import ExceptionClassifier
 
 
 __version__ = '0.2.1'
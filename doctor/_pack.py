@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact little-endian columnar packing shared by ``doctor.checkpoint`` and
+``doctor.aggregator``: keys are utf-8 encoded and joined by ``\\n``,
+prefixed with the length (u32), numbers are packed as arrays.
+"""
+
+from __future__ import absolute_import
+
+import sys
+import struct
+from array import array
+
+
+COUNT = struct.Struct('<I')
+
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def pack_keys(keys):
+    blob = '\n'.join(keys).encode('utf-8')
+    return COUNT.pack(len(blob)) + blob
+
+
+def unpack_keys(buf, offset, count):
+    length, = COUNT.unpack_from(buf, offset)
+    offset += COUNT.size
+    if not count:
+        return [], offset + length
+    blob = buf[offset:offset + length].tobytes()
+    return blob.decode('utf-8').split('\n'), offset + length
+
+
+def pack_array(typecode, items):
+    arr = array(typecode, items)
+    if _BIG_ENDIAN:
+        arr.byteswap()
+    return arr.tobytes() if hasattr(arr, 'tobytes') else arr.tostring()
+
+
+def unpack_array(typecode, buf, offset, count):
+    arr = array(typecode)
+    end = offset + arr.itemsize * count
+    data = buf[offset:end].tobytes()
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+    if _BIG_ENDIAN:
+        arr.byteswap()
+    return arr, end
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+"""
+Aggregator
+==========
+
+Share metrics and lock decisions among doctor processes on a host, via a
+local aggregator process::
+
+    $ python -m doctor.aggregator /var/run/doctor.sock
+
+    client = AggregatorClient(tester, '/var/run/doctor.sock')
+    client.start()
+
+Clients push counter deltas (increments since the last push) and the apis
+they locked to the aggregator in batches, the aggregator merges the deltas
+into its own rolling windows, and replies the merged values of the pushed
+counters and the apis locked by other clients. Clients blend the merged
+values into ``Metrics.get`` and lock the apis locked elsewhere.
+
+All traffic is datagrams over a Unix domain socket (`address` as a path) or
+local UDP (`address` as ``(host, port)``), sent and received in a daemon
+thread without blocking. If the aggregator is gone, pushes are dropped and
+merged values expire, clients fall back to local metrics (fail-open).
+
+Message format (little-endian, see ``doctor._pack``)::
+
+    header   magic 'DRAG', version (u8), type (u8, 1 push, 2 reply)
+    values   count (u32), keys, count * value (i32)
+    locks    count (u32), keys
+
+Values are deltas in pushes, merged values in replies.
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import struct
+import logging
+import threading
+
+from .configs import Configs
+from .metrics import Metrics
+from ._pack import COUNT, pack_keys, unpack_keys, pack_array, unpack_array
+
+
+MAGIC = b'DRAG'
+VERSION = 1
+TYPE_PUSH = 1
+TYPE_REPLY = 2
+
+# counters per datagram, keeps datagrams far below the size limits.
+BATCH_SIZE = 512
+MAX_DATAGRAM_SIZE = 65507
+
+_HEADER = struct.Struct('<4sBB')
+
+logger = logging.getLogger(__name__)
+
+
+class AggregatorError(Exception):
+    pass
+
+
+def pack_message(type, values, locks):
+    """Pack ``{key: value}`` `values` and `locks` keys into a datagram."""
+    keys = list(values)
+    return b''.join([_HEADER.pack(MAGIC, VERSION, type),
+                     COUNT.pack(len(keys)),
+                     pack_keys(keys),
+                     pack_array('i', [values[key] for key in keys]),
+                     COUNT.pack(len(locks)),
+                     pack_keys(locks)])
+
+
+def unpack_message(data):
+    """Unpack a datagram, returns ``(type, {key: value}, locks)``."""
+    buf = memoryview(data)
+    try:
+        magic, version, type = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise AggregatorError('Bad message header')
+        offset = _HEADER.size
+        count, = COUNT.unpack_from(buf, offset)
+        keys, offset = unpack_keys(buf, offset + COUNT.size, count)
+        values, offset = unpack_array('i', buf, offset, count)
+        count, = COUNT.unpack_from(buf, offset)
+        locks, offset = unpack_keys(buf, offset + COUNT.size, count)
+    except (struct.error, UnicodeDecodeError, ValueError) as exc:
+        raise AggregatorError('Bad message: {0}'.format(exc))
+    return type, dict(zip(keys, values)), locks
+
+
+def _make_socket(address):
+    if isinstance(address, (tuple, list)):
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+
+class Aggregator(object):
+    """
+    The aggregator server, merges the pushed deltas into rolling windows of
+    `configs` (``METRICS_*`` settings), and tracks the locks pushed by each
+    client, locks expire if not pushed again in `lock_ttl` seconds.
+
+    Parameters::
+
+    * address: Unix domain socket path, or ``(host, port)`` for UDP.
+    * configs: ``Configs`` object, default to ``Configs()``.
+    * lock_ttl: seconds to keep a pushed lock.
+    """
+
+    def __init__(self, address, configs=None, lock_ttl=5):
+        self.address = address
+        self.metrics = Metrics(configs or Configs())
+        self.lock_ttl = lock_ttl
+        # {key: {client address: expires_at}}
+        self._locks = dict()
+        self._sock = None
+
+    def bind(self):
+        """Bind the socket, remove the stale socket file first if any."""
+        if not isinstance(self.address, (tuple, list)):
+            try:
+                os.unlink(self.address)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+        self._sock = _make_socket(self.address)
+        self._sock.bind(self.address)
+        if isinstance(self.address, (tuple, list)):
+            self.address = self._sock.getsockname()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if not isinstance(self.address, (tuple, list)):
+                try:
+                    os.unlink(self.address)
+                except OSError:
+                    pass
+
+    def handle(self, data, client):
+        """Handle a pushed datagram from `client`, returns the reply."""
+        type, deltas, locks = unpack_message(data)
+        if type != TYPE_PUSH:
+            raise AggregatorError('Unexpected message type: {0}'.format(type))
+
+        metrics = self.metrics
+        values = dict()
+        for key, delta in deltas.items():
+            if delta:
+                metrics.incr(key, delta)
+            values[key] = metrics.get(key)
+
+        now = time.time()
+        expires_at = now + self.lock_ttl
+        for key in locks:
+            self._locks.setdefault(key, dict())[client] = expires_at
+
+        other_locks = []
+        for key, clients in list(self._locks.items()):
+            for addr, lock_expires_at in list(clients.items()):
+                if lock_expires_at <= now:
+                    del clients[addr]
+            if not clients:
+                del self._locks[key]
+            elif any(addr != client for addr in clients):
+                other_locks.append(key)
+        return pack_message(TYPE_REPLY, values, other_locks)
+
+    def serve_once(self, timeout=None):
+        """
+        Handle one datagram, waits at most `timeout` seconds, returns
+        ``False`` on timeout.
+        """
+        self._sock.settimeout(timeout)
+        try:
+            data, client = self._sock.recvfrom(MAX_DATAGRAM_SIZE)
+        except socket.timeout:
+            return False
+        try:
+            reply = self.handle(data, client)
+        except AggregatorError as exc:
+            logger.warning('Drop message from %r: %s', client, exc)
+            return True
+        if client:
+            try:
+                self._sock.sendto(reply, client)
+            except socket.error as exc:
+                logger.debug('Failed to reply %r: %s', client, exc)
+        return True
+
+    def serve_forever(self):
+        while True:
+            self.serve_once()
+
+
+class AggregatorClient(object):
+    """
+    Push the metrics of `tester` to the aggregator and blend the replies
+    into its metrics, in a daemon thread (:meth:`start`), or by calling
+    :meth:`flush` and :meth:`poll` directly. The request path never touches
+    the socket.
+
+    Parameters::
+
+    * tester: ``HealthTester`` object.
+    * address: the aggregator address, see ``Aggregator``.
+    * interval: seconds between two pushes in the thread.
+    * ttl: seconds to blend a reply, default to ``3 * interval``.
+    """
+
+    def __init__(self, tester, address, interval=1, ttl=None):
+        self.tester = tester
+        self.address = address
+        self.interval = interval
+        self.ttl = 3 * interval if ttl is None else ttl
+        # {key: counter total} pushed.
+        self._sent = dict()
+        self._last_reply_at = 0
+        self._sock = None
+        self._sock_path = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _socket(self):
+        if self._sock is None:
+            sock = _make_socket(self.address)
+            if not isinstance(self.address, (tuple, list)):
+                # replies need a bound path on Unix domain sockets.
+                self._sock_path = '{0}.{1}.{2}'.format(
+                    self.address, os.getpid(), id(self))
+                try:
+                    os.unlink(self._sock_path)
+                except OSError:
+                    pass
+                sock.bind(self._sock_path)
+            sock.setblocking(False)
+            self._sock = sock
+        return self._sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._sock_path is not None:
+            try:
+                os.unlink(self._sock_path)
+            except OSError:
+                pass
+            self._sock_path = None
+
+    def flush(self):
+        """
+        Push counter deltas and locks, returns the number of datagrams sent,
+        pushes are dropped if the aggregator is not reachable.
+        """
+        deltas = dict()
+        for key, counter in list(self.tester.metrics.counters.items()):
+            total = counter.total
+            delta = total - self._sent.get(key, 0)
+            if delta or key in self._sent:
+                deltas[key] = (delta, total)
+
+        keys = list(deltas)
+        batches = [keys[i:i + BATCH_SIZE]
+                   for i in range(0, len(keys), BATCH_SIZE)] or [[]]
+        # only push locks decided by local health, not the ones adopted from
+        # `remote_locks`, or locks would never expire among clients.
+        locks = self.tester.locally_locked_keys()
+        sent = 0
+        for i, batch in enumerate(batches):
+            data = pack_message(
+                TYPE_PUSH, dict((key, deltas[key][0]) for key in batch),
+                locks if i == 0 else [])
+            try:
+                self._socket().sendto(data, self.address)
+            except socket.error as exc:
+                logger.debug('Failed to push to aggregator %r: %s',
+                             self.address, exc)
+                continue
+            for key in batch:
+                self._sent[key] = deltas[key][1]
+            sent += 1
+        return sent
+
+    def poll(self):
+        """
+        Receive replies without blocking and blend them into metrics,
+        returns the number of replies received. Blended values are dropped
+        if no reply is received in `ttl`.
+        """
+        metrics = self.tester.metrics
+        received = 0
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(MAX_DATAGRAM_SIZE)
+            except socket.error as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logger.debug('Failed to receive from aggregator: %s', exc)
+                break
+            try:
+                type, values, locks = unpack_message(data)
+            except AggregatorError as exc:
+                logger.warning('Drop message from aggregator: %s', exc)
+                continue
+            now = time.time()
+            metrics.update_remote(values, self._sent, now + self.ttl, locks)
+            self._last_reply_at = now
+            received += 1
+
+        if not received and self._last_reply_at and \
+                time.time() - self._last_reply_at > self.ttl:
+            metrics.clear_remote()
+            self._last_reply_at = 0
+        return received
+
+    def start(self):
+        """Start a daemon thread to push and poll every `interval`."""
+        if self._thread is not None:
+            raise RuntimeError('AggregatorClient is already started')
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.close()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+                self.flush()
+            except Exception:
+                logger.exception('Failed to sync with aggregator %r',
+                                 self.address)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='doctor aggregator')
+    parser.add_argument('address',
+                        help='Unix domain socket path, or host:port for UDP')
+    parser.add_argument('--granularity', type=int,
+                        default=Configs().METRICS_GRANULARITY)
+    parser.add_argument('--rollingsize', type=int,
+                        default=Configs().METRICS_ROLLINGSIZE)
+    parser.add_argument('--lock-ttl', type=float, default=5)
+    args = parser.parse_args(argv)
+
+    address = args.address
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+    configs = Configs({'METRICS_GRANULARITY': args.granularity,
+                       'METRICS_ROLLINGSIZE': args.rollingsize})
+    logging.basicConfig(level=logging.INFO)
+    aggregator = Aggregator(address, configs, lock_ttl=args.lock_ttl)
+    aggregator.bind()
+    logger.info('Aggregator serving on %r', aggregator.address)
+    try:
+        aggregator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        aggregator.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,13 +7,26 @@ import random
 import logging
 from collections import defaultdict
 
-from .metrics import Metrics
+from .metrics import Metrics, SERVICE_FUNC_NAME, HEALTHY_FOREVER
 
 
 MODE_UNLOCKED = 0
 MODE_LOCKED = 1
 MODE_RECOVER = 2
 
+# Priority of requests tested without a known priority.
+DEFAULT_PRIORITY = 'default'
+
+# Test decisions counted by ``TesterStats``.
+DECISION_ALLOWED = 'allowed'
+DECISION_REJECTED = 'rejected'
+DECISION_PROBE = 'probe'
+
+_MODE_NAMES = {MODE_UNLOCKED: 'unlocked', MODE_LOCKED: 'locked',
+               MODE_RECOVER: 'recover'}
+
+_timer = getattr(time, 'perf_counter', time.time)
+
 
 class APIHealthTestCtx(object):
     """
@@ -25,18 +38,155 @@ class APIHealthTestCtx(object):
         lock            current api lock information, dict,
                         keys: ``locked_at``, ``locked_status``.
         health_ok_now   if the api is ok now, True for ok.
+        priority        the priority passed to `test`.
         start_at        timestamp when the test starts.
         end_at          timestamp when the test ends.
         logger          service logger
     """
     __slots__ = ['func_name', 'service_name', 'result', 'lock',
-                 'health_ok_now', 'start_at', 'end_at', 'logger']
+                 'health_ok_now', 'priority', 'start_at', 'end_at', 'logger']
 
     def __init__(self):
         for attr in self.__slots__:
             setattr(self, attr, None)
 
 
+class HealthPolicy(object):
+    """
+    Health settings compiled from ``Configs``, read by ``HealthTester`` on
+    each test. A policy is never changed once created, reloading swaps in a
+    new one instead, so a test always sees consistent settings without any
+    locking.
+    """
+    __slots__ = ['min_recovery_time', 'max_recovery_time',
+                 'threshold_request', 'threshold_timeout',
+                 'threshold_sys_exc', 'threshold_unkwn_exc',
+                 'threshold_consecutive_failures', 'error_free_healthy',
+                 'service_breaker', 'priority_weights', 'priority_counters',
+                 'default_priority_counter', 'priority_classes',
+                 'degraded_ratio', 'retry_budget_ratio', 'retry_budget_min',
+                 'interval']
+
+    def __init__(self, configs):
+        self.min_recovery_time = configs.HEALTH_MIN_RECOVERY_TIME
+        self.max_recovery_time = configs.HEALTH_MAX_RECOVERY_TIME
+        self.threshold_request = configs.HEALTH_THRESHOLD_REQUEST
+        self.threshold_timeout = configs.HEALTH_THRESHOLD_TIMEOUT
+        self.threshold_sys_exc = configs.HEALTH_THRESHOLD_SYS_EXC
+        self.threshold_unkwn_exc = configs.HEALTH_THRESHOLD_UNKWN_EXC
+        self.threshold_consecutive_failures = \
+            configs.HEALTH_THRESHOLD_CONSECUTIVE_FAILURES
+        # an api without errors is healthy only if all thresholds are
+        # positive, its verdict can be cached in `metrics.healthy_apis`.
+        self.error_free_healthy = (self.threshold_timeout > 0 and
+                                   self.threshold_sys_exc > 0 and
+                                   self.threshold_unkwn_exc > 0)
+        self.service_breaker = configs.HEALTH_SERVICE_BREAKER
+
+        # priorities not in weights are counted as `default` with weight 1.
+        self.priority_weights = dict(configs.HEALTH_PRIORITY_WEIGHTS or {})
+        self.priority_weights.pop(DEFAULT_PRIORITY, None)
+        self.priority_counters = dict(
+            (priority, '.priority.{0}'.format(priority))
+            for priority in self.priority_weights)
+        self.default_priority_counter = '.priority.{0}'.format(
+            DEFAULT_PRIORITY)
+        # (weight, counter suffix) of all priorities, heaviest first.
+        self.priority_classes = sorted(
+            [(weight, self.priority_counters[priority])
+             for priority, weight in self.priority_weights.items()] +
+            [(1.0, self.default_priority_counter)],
+            reverse=True)
+        self.degraded_ratio = configs.HEALTH_DEGRADED_RATIO
+        self.retry_budget_ratio = configs.HEALTH_RETRY_BUDGET_RATIO
+        self.retry_budget_min = configs.HEALTH_RETRY_BUDGET_MIN
+
+        granularity = configs.METRICS_GRANULARITY
+        rollingsize = configs.METRICS_ROLLINGSIZE
+        self.interval = granularity * rollingsize
+
+
+class TesterStats(object):
+    """
+    Internal stats of a ``HealthTester``, to track the cost of doctor
+    itself. Decisions of all tests are counted by the lock state they are
+    made in, one in `sampling` tests is timed:
+
+    * test         time spent in :meth:`HealthTester.test`, in total.
+    * is_healthy   time spent checking health by metrics, in tests or by
+                   :meth:`HealthTester.is_healthy`.
+    * callbacks    time spent in callbacks, in tests.
+
+    Read by :meth:`snapshot`, timings are in seconds. Window shifts are
+    read from the tester's `metrics`.
+    """
+
+    TIMINGS = ('test', 'is_healthy', 'callbacks')
+
+    def __init__(self, sampling, metrics):
+        self.sampling = sampling
+        self._countdown = sampling
+        self._metrics = metrics
+        self.reset()
+
+    def reset(self):
+        """Reset all stats to zero."""
+        # {(locked_status, decision): count}
+        self._decisions = dict()
+        # {name: [count, total, max]}
+        self._timings = dict((name, [0, 0.0, 0.0]) for name in self.TIMINGS)
+        self._shifts = self._metrics.window_shifts
+
+    def sample(self):
+        """Return `True` once in `sampling` calls."""
+        self._countdown -= 1
+        if self._countdown > 0:
+            return False
+        self._countdown = self.sampling
+        return True
+
+    def count(self, locked_status, decision):
+        key = (locked_status, decision)
+        self._decisions[key] = self._decisions.get(key, 0) + 1
+
+    def observe(self, name, seconds):
+        timing = self._timings[name]
+        timing[0] += 1
+        timing[1] += seconds
+        if seconds > timing[2]:
+            timing[2] = seconds
+
+    def snapshot(self):
+        """
+        Return the stats as a dict::
+
+            {'sampling': N,
+             'window_shifts': rolling window shifts of the tester's
+                              metrics since reset,
+             'decisions': {'unlocked': {'allowed': n, 'rejected': n},
+                           'locked': {'rejected': n, 'probe': n},
+                           'recover': {...}},
+             'timings': {'test': {'count': n, 'total': seconds,
+                                  'mean': seconds, 'max': seconds},
+                         'is_healthy': {...}, 'callbacks': {...}}}
+
+        `probe` is the request released for health checking when an api
+        enters recover mode.
+        """
+        decisions = dict((name, dict()) for name in _MODE_NAMES.values())
+        for (locked_status, decision), count in list(
+                self._decisions.items()):
+            decisions[_MODE_NAMES[locked_status]][decision] = count
+        timings = dict()
+        for name, (count, total, max_) in list(self._timings.items()):
+            timings[name] = {'count': count, 'total': total, 'max': max_,
+                             'mean': total / count if count else 0.0}
+        return {'sampling': self.sampling,
+                'window_shifts': self._metrics.window_shifts - self._shifts,
+                'decisions': decisions,
+                'timings': timings}
+
+
 class HealthTester(object):
     """
     Parameters::
@@ -53,17 +203,9 @@ class HealthTester(object):
                  on_api_health_tested_ok=_NON_CALLBACK):
         self._metrics = Metrics(configs)
 
-        # init settings
-        self._min_recovery_time = configs.HEALTH_MIN_RECOVERY_TIME
-        self._max_recovery_time = configs.HEALTH_MAX_RECOVERY_TIME
-        self._threshold_request = configs.HEALTH_THRESHOLD_REQUEST
-        self._threshold_timeout = configs.HEALTH_THRESHOLD_TIMEOUT
-        self._threshold_sys_exc = configs.HEALTH_THRESHOLD_SYS_EXC
-        self._threshold_unkwn_exc = configs.HEALTH_THRESHOLD_UNKWN_EXC
-
-        granularity = configs.METRICS_GRANULARITY
-        rollingsize = configs.METRICS_ROLLINGSIZE
-        self._interval = granularity * rollingsize
+        self._policy = HealthPolicy(configs)
+        self._healthy_apis = self._metrics.healthy_apis
+        self._remote_locks = self._metrics.remote_locks
 
         # callbacks
         self._on_api_health_locked = on_api_health_locked
@@ -74,11 +216,50 @@ class HealthTester(object):
 
         self._locks = defaultdict(dict)
 
+        self._stats = None
+        if configs.HEALTH_STATS_SAMPLING:
+            self._stats = TesterStats(configs.HEALTH_STATS_SAMPLING,
+                                      self._metrics)
+
     @property
     def metrics(self):
         """``Metrics`` object."""
         return self._metrics
 
+    @property
+    def stats(self):
+        """
+        ``TesterStats`` object, ``None`` if `STATS_SAMPLING` is `0`.
+        """
+        return self._stats
+
+    @property
+    def policy(self):
+        """Current ``HealthPolicy`` object."""
+        return self._policy
+
+    def reload(self, configs):
+        """
+        Reload settings from `configs` (a ``Configs`` object) on the fly.
+        The rolling windows of existing metrics are resized in place (see
+        :meth:`Metrics.reload`), locks and latest states are kept, then the
+        new ``HealthPolicy`` is swapped in and cached verdicts are cleared.
+        """
+        policy = HealthPolicy(configs)
+        self._metrics.reload(configs)
+        self._policy = policy
+        # cached verdicts depend on thresholds, cleared after the swap so
+        # no verdict of the old policy is cached again.
+        self._healthy_apis.clear()
+
+        sampling = configs.HEALTH_STATS_SAMPLING
+        if not sampling:
+            self._stats = None
+        elif self._stats is None:
+            self._stats = TesterStats(sampling, self._metrics)
+        else:
+            self._stats.sampling = sampling
+
     @property
     def locks(self):
         """
@@ -87,6 +268,8 @@ class HealthTester(object):
             {func_slug: {locked_at: locked_time,
                         locked_status: status of lock}}
 
+        Locks of whole services are keyed by ``service.*``.
+
         * locked_at: the time when the fun is locked
         * locked_status: the status of lock
             #. locked:   the func is locked
@@ -97,12 +280,15 @@ class HealthTester(object):
         """
         return self._locks
 
-    def test(self, service_name, func_name, logger=None):
+    def test(self, service_name, func_name, logger=None, priority=None):
         """
         Test current api health before the request is processed, returns
         ``True`` for OK, logic notes:
 
-        * If current api is `unlocked`, lock it until `not is_healthy()`.
+        * If current api is `unlocked`, lock it until `not is_healthy()`, or
+          until it failed `THRESHOLD_CONSECUTIVE_FAILURES` times in a row
+          (timeouts and sys_excs, see :meth:`is_failing_in_a_row`), or until
+          it is locked by other processes (see ``metrics.remote_locks``).
         * If current api is `locked`, recover it until `is_healthy()` (and
           locked time span > `MIN_RECOVERY_TIME`), one request will be
           released for health checking once this api enters recover mode.
@@ -113,25 +299,137 @@ class HealthTester(object):
           time turns to health OK, but it will be unlock anyway when the time
           span is over `MAX_RECOVERY_TIME`. If the latest request failed with
           any errors exccept
-          `too_busy_exception`, it will be locked again.
+          `too_busy_exception`, or it is still failing in a row, it will be
+          locked again.
+
+        If `SERVICE_BREAKER` is enabled, the same policy is applied on the
+        whole service (by the aggregated metrics of all its apis, see
+        :meth:`is_service_healthy`) before the api itself, a locked service
+        refuses the requests of all its apis. Service lock changes are sent
+        to callbacks with ``ctx.func_name`` as ``'*'``.
+
+        If `PRIORITY_WEIGHTS` is set, requests tested with a `priority` share
+        the admission in `recover` mode by their weights: the admitted
+        fraction of all requests stays the same, but heavier priorities are
+        admitted first (see :meth:`priority_fraction`), the requests of each
+        priority are counted in metrics (``service.func.priority.<name>``)
+        while the api is not `unlocked`. Unknown priorities (and ``None``)
+        weigh ``1``. If `DEGRADED_RATIO` is set too, an `unlocked` api with
+        errors over ``DEGRADED_RATIO * THRESHOLD_*`` is degraded, requests
+        lighter than ``1`` are admitted by the chance of their weights.
+
+        If `STATS_SAMPLING` is set, decisions and sampled timings are
+        recorded in :attr:`stats`.
         """
-        key = '{0}.{1}'.format(service_name, func_name)
-
-        lock = self._get_api_lock(key)
-        locked_at = lock['locked_at']
-        locked_status = lock['locked_status']
+        return self.test_api(self._metrics.api(service_name, func_name),
+                             logger, priority)
 
-        health_ok_now = self.is_healthy(service_name, func_name)
+    def test_api(self, api, logger=None, priority=None):
+        """
+        Same to :meth:`test`, but on an ``APIMetrics`` handle (see
+        ``metrics.api``), callers keeping the handle skip its lookup.
+        """
+        policy = self._policy
+        stats = self._stats
+        timed = stats is not None and stats.sample()
+        if timed:
+            started = _timer()
+        service_name, func_name = api.service_name, api.func_name
+        key = api.key
         time_now = time.time()
 
         if not logger:
             logger = logging.getLogger(__name__)
+
+        if policy.service_breaker:
+            service_key = api.service_key
+            service_lock = self._get_api_lock(service_key)
+            service_status = service_lock['locked_status']
+            service_ok_now = (
+                self._healthy_apis.get(service_key, 0) > time_now or
+                self._is_key_healthy(service_key, policy))
+            result, lock_changed = self._test_lock(
+                service_key, service_lock, service_ok_now, time_now, policy,
+                priority)
+            if lock_changed is not None:
+                ctx = self._make_ctx(service_name, SERVICE_FUNC_NAME,
+                                     service_ok_now, time_now, logger,
+                                     priority)
+                ctx.end_at = time.time()
+                ctx.result = result
+                ctx.lock = service_lock.copy()
+                self._send_lock_changed_ctx(ctx, lock_changed)
+            if not result:
+                # the whole service is locked, functions are not tested.
+                ctx = self._make_ctx(service_name, func_name, None,
+                                     time_now, logger, priority)
+                ctx.end_at = time.time()
+                ctx.result = result
+                ctx.lock = service_lock.copy()
+                self._send_test_call_ctx(ctx, result, None)
+                if stats is not None:
+                    stats.count(service_status, DECISION_REJECTED)
+                    if timed:
+                        stats.observe('test', _timer() - started)
+                return result
+
+        lock = self._get_api_lock(key)
+        locked_status = lock['locked_status']
+        if timed:
+            checked = _timer()
+        health_ok_now = (self._healthy_apis.get(key, 0) > time_now or
+                         self._is_key_healthy(key, policy))
+        if timed:
+            stats.observe('is_healthy', _timer() - checked)
+        ctx = self._make_ctx(service_name, func_name, health_ok_now,
+                             time_now, logger, priority)
+        result, lock_changed = self._test_lock(key, lock, health_ok_now,
+                                               time_now, policy, priority)
+
+        ctx.end_at = time.time()
+        ctx.result = result
+        ctx.lock = lock.copy()
+        # call callbacks.
+        if timed:
+            called = _timer()
+        self._send_test_call_ctx(ctx, result, lock_changed)
+
+        if stats is not None:
+            if lock_changed == MODE_RECOVER:
+                stats.count(locked_status, DECISION_PROBE)
+            elif result:
+                stats.count(locked_status, DECISION_ALLOWED)
+            else:
+                stats.count(locked_status, DECISION_REJECTED)
+            if timed:
+                now = _timer()
+                stats.observe('callbacks', now - called)
+                stats.observe('test', now - started)
+        return result
+
+    def _make_ctx(self, service_name, func_name, health_ok_now, time_now,
+                  logger, priority=None):
         ctx = APIHealthTestCtx()
         ctx.start_at = time_now
         ctx.func_name = func_name
         ctx.service_name = service_name
         ctx.health_ok_now = health_ok_now
+        ctx.priority = priority
         ctx.logger = logger
+        return ctx
+
+    def _test_lock(self, key, lock, health_ok_now, time_now, policy,
+                   priority=None):
+        """
+        Run the lock state machine described in :meth:`test` on `lock`,
+        returns a tuple ``(result, lock_changed)``.
+        """
+        locked_at = lock['locked_at']
+        locked_status = lock['locked_status']
+
+        if locked_status != MODE_UNLOCKED and policy.priority_weights:
+            self._metrics.incr(key + policy.priority_counters.get(
+                priority, policy.default_priority_counter))
 
         lock_changed = None
         result = None
@@ -140,7 +438,7 @@ class HealthTester(object):
             if health_ok_now:
                 # turns OK
                 locked_span = time_now - locked_at
-                if locked_span < self._min_recovery_time:
+                if locked_span < policy.min_recovery_time:
                     # should be locked for at least MIN_RECOVERY_TIME
                     result = False
                 else:
@@ -152,16 +450,20 @@ class HealthTester(object):
             else:
                 result = False
         elif locked_status == MODE_RECOVER:
-            if self._metrics.api_latest_state.get(key, False):
+            if (self._metrics.api_latest_state.get(key, False) and
+                    not self._is_failure_streak_over(key, policy)):
                 locked_span = time_now - locked_at
-                if locked_span >= self._max_recovery_time:
+                if locked_span >= policy.max_recovery_time:
                     lock['locked_at'] = 0
                     lock['locked_status'] = MODE_UNLOCKED
                     lock_changed = MODE_UNLOCKED
                     result = True
                 else:
-                    if (random.random() <
-                            float(locked_span) / self._max_recovery_time):
+                    fraction = float(locked_span) / policy.max_recovery_time
+                    if policy.priority_weights:
+                        fraction = self._priority_fraction(
+                            key, priority, fraction, policy)
+                    if random.random() < fraction:
                         # allow pass gradually
                         result = True
                     else:
@@ -175,7 +477,9 @@ class HealthTester(object):
                 result = False
         else:
             # not in locked mode now
-            if not health_ok_now:
+            if (not health_ok_now or
+                    self._is_failure_streak_over(key, policy) or
+                    (self._remote_locks and key in self._remote_locks)):
                 # turns BAD
                 lock['locked_at'] = time_now
                 lock['locked_status'] = MODE_LOCKED
@@ -184,13 +488,74 @@ class HealthTester(object):
             else:
                 # still OK
                 result = True
-
-        ctx.end_at = time.time()
-        ctx.result = result
-        ctx.lock = lock.copy()
-        # call callbacks.
-        self._send_test_call_ctx(ctx, result, lock_changed)
-        return result
+                if (policy.degraded_ratio and policy.priority_weights and
+                        self._healthy_apis.get(key) != HEALTHY_FOREVER and
+                        self._is_key_degraded(key, policy)):
+                    # shed light requests before locked.
+                    weight = policy.priority_weights.get(priority, 1.0)
+                    result = weight >= 1 or random.random() < weight
+
+        return result, lock_changed
+
+    def _priority_fraction(self, key, priority, fraction, policy):
+        counts = [(weight, self._metrics.get(key + suffix))
+                  for weight, suffix in policy.priority_classes]
+        total = sum(count for _, count in counts)
+        if not total:
+            return fraction
+        # water-filling: find `k` that admits `fraction` of all requests,
+        # with priorities admitted by `min(1, k * weight)`.
+        budget = fraction * total
+        weighted = float(sum(weight * count for weight, count in counts))
+        for weight, count in counts:
+            if not count:
+                continue
+            if weighted <= 0 or budget * weight < weighted:
+                break
+            # heaviest priority saturated, admitted fully.
+            budget -= count
+            weighted -= weight * count
+        if weighted <= 0:
+            return 1.0
+        k = budget / weighted
+        return min(1.0, k * policy.priority_weights.get(priority, 1.0))
+
+    def priority_fraction(self, service_name, func_name, priority, fraction):
+        """
+        Return the fraction of `priority` requests to admit, when `fraction`
+        of all requests on the api are admitted, by the requests of each
+        priority counted in metrics. Priorities are admitted by
+        ``min(1, k * weight)``, with `k` solved to keep the admitted
+        fraction of all requests, so heavier priorities saturate first.
+        """
+        return self._priority_fraction(
+            '{0}.{1}'.format(service_name, func_name), priority, fraction,
+            self._policy)
+
+    def _is_key_degraded(self, key, policy):
+        requests = self._metrics.get(key)
+        if requests <= policy.threshold_request:
+            return False
+        ratio = policy.degraded_ratio * float(requests)
+        return (self._metrics.get(key + '.timeout') >=
+                ratio * policy.threshold_timeout or
+                self._metrics.get(key + '.sys_exc') >=
+                ratio * policy.threshold_sys_exc or
+                self._metrics.get(key + '.unkwn_exc') >=
+                ratio * policy.threshold_unkwn_exc)
+
+    def locally_locked_keys(self):
+        """
+        Return the keys of the locked apis (and services) which are still
+        unhealthy or failing in a row by local metrics, not the ones locked
+        only by other processes (see ``metrics.remote_locks``). No verdict
+        is cached by the checks, safe to call from other threads.
+        """
+        policy = self._policy
+        return [key for key, lock in list(self._locks.items())
+                if lock.get('locked_status') == MODE_LOCKED and
+                (not self._key_health(key, policy)[0] or
+                 self._is_failure_streak_over(key, policy))]
 
     def _get_api_lock(self, key):
         if key not in self._locks:
@@ -198,12 +563,53 @@ class HealthTester(object):
             self._locks[key]['locked_status'] = MODE_UNLOCKED
         return self._locks[key]
 
-    def _send_test_call_ctx(self, ctx, result, lock_changed):
+    def _is_failure_streak_over(self, key, policy):
+        threshold = policy.threshold_consecutive_failures
+        return (threshold > 0 and
+                self._metrics.api_failure_streak.get(key, 0) >= threshold)
+
+    def is_failing_in_a_row(self, service_name, func_name):
+        """
+        Check if current api failed (with timeouts or sys_excs) at least
+        `THRESHOLD_CONSECUTIVE_FAILURES` times in a row, returns `True` for
+        failing. Unlike :meth:`is_healthy`, no rolling window is summed, so
+        low-QPS apis can be locked before `THRESHOLD_REQUEST` is reached.
+        Always returns `False` if `THRESHOLD_CONSECUTIVE_FAILURES` is `0`.
+        """
+        return self._is_failure_streak_over(
+            '{0}.{1}'.format(service_name, func_name), self._policy)
+
+    def can_retry(self, service_name, func_name):
+        """
+        Check if a failed call on current api can be retried, by its retry
+        budget, returns `True` to retry::
+
+            retries < RETRY_BUDGET_MIN or
+                retries / requests < RETRY_BUDGET_RATIO
+
+        Retries are counted by recording calls with ``retry=True`` (see
+        ``metrics.on_api_called``), in the same rolling window as requests.
+        Costs O(1), the window sums are maintained on writes. Always returns
+        `True` if `RETRY_BUDGET_RATIO` is `0`.
+        """
+        policy = self._policy
+        if not policy.retry_budget_ratio:
+            return True
+        key = '{0}.{1}'.format(service_name, func_name)
+        retries = self._metrics.get(key + '.retry')
+        if retries < policy.retry_budget_min:
+            return True
+        return retries < policy.retry_budget_ratio * self._metrics.get(key)
+
+    def _send_lock_changed_ctx(self, ctx, lock_changed):
         if lock_changed == MODE_LOCKED:
             self._on_api_health_locked(ctx)
         elif lock_changed == MODE_UNLOCKED:
             self._on_api_health_unlocked(ctx)
 
+    def _send_test_call_ctx(self, ctx, result, lock_changed):
+        self._send_lock_changed_ctx(ctx, lock_changed)
+
         self._on_api_health_tested(ctx)
         if result:
             self._on_api_health_tested_ok(ctx)
@@ -220,19 +626,62 @@ class HealthTester(object):
                     sys_excs / requests > THRESHOLD_SYS_EXC:
                     return False
             return True
+
+        Healthy verdicts are cached in ``metrics.healthy_apis`` until an
+        error is recorded or the window shifts, so the common path costs
+        only a dict lookup.
+        """
+        key = '{0}.{1}'.format(service_name, func_name)
+        stats = self._stats
+        if stats is not None and stats.sample():
+            started = _timer()
+            result = (self._healthy_apis.get(key, 0) > time.time() or
+                      self._is_key_healthy(key, self._policy))
+            stats.observe('is_healthy', _timer() - started)
+            return result
+        return (self._healthy_apis.get(key, 0) > time.time() or
+                self._is_key_healthy(key, self._policy))
+
+    def is_service_healthy(self, service_name):
+        """
+        Check current service health status by the metrics aggregated over
+        all its apis, with the same thresholds as :meth:`is_healthy`. The
+        aggregated metrics are recorded only if `SERVICE_BREAKER` is enabled.
         """
-        key_request = '{0}.{1}'.format(service_name, func_name)
-        key_timeout = '{0}.timeout'.format(key_request)
-        key_sys_exc = '{0}.sys_exc'.format(key_request)
-        key_unkwn_exc = '{0}.unkwn_exc'.format(key_request)
+        key = '{0}.{1}'.format(service_name, SERVICE_FUNC_NAME)
+        return (self._healthy_apis.get(key, 0) > time.time() or
+                self._is_key_healthy(key, self._policy))
+
+    def _is_key_healthy(self, key, policy):
+        healthy, expires_at = self._key_health(key, policy)
+        if expires_at:
+            self._healthy_apis[key] = expires_at
+        return healthy
+
+    def _key_health(self, key, policy):
+        # returns `(healthy, expires_at)`, the verdict can be cached until
+        # `expires_at` if not `0`, no side effects.
+        key_timeout = '{0}.timeout'.format(key)
+        key_sys_exc = '{0}.sys_exc'.format(key)
+        key_unkwn_exc = '{0}.unkwn_exc'.format(key)
 
-        requests = self._metrics.get(key_request)
         timeouts = self._metrics.get(key_timeout)
         sys_excs = self._metrics.get(key_sys_exc)
         unkwn_exc = self._metrics.get(key_unkwn_exc)
 
-        if requests > self._threshold_request:
-            return (((timeouts / float(requests)) < self._threshold_timeout) and
-                    ((sys_excs / float(requests)) < self._threshold_sys_exc) and
-                    ((unkwn_exc / float(requests)) < self._threshold_unkwn_exc))
-        return True
+        if not (timeouts or sys_excs or unkwn_exc) and \
+                policy.error_free_healthy:
+            # stays healthy until any error is recorded.
+            return True, HEALTHY_FOREVER
+
+        requests = self._metrics.get(key)
+        if requests > policy.threshold_request:
+            healthy = (
+                ((timeouts / float(requests)) < policy.threshold_timeout) and
+                ((sys_excs / float(requests)) < policy.threshold_sys_exc) and
+                ((unkwn_exc / float(requests)) < policy.threshold_unkwn_exc))
+            # new requests only lower the error ratios, until errors are
+            # recorded or the requests window shifts.
+            return healthy, healthy and self._metrics.next_shift_at(key)
+        # too few requests, new requests alone may flip the verdict.
+        return True, 0
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+"""
+Checkpoint
+==========
+
+Warm-start persistence of ``HealthTester`` runtime data (metrics windows,
+api latest states, failure streaks and locks) across process restarts.
+
+File format (little-endian), columnar so that restoring is mostly done by
+bulk decoding::
+
+    header   magic 'DRCK', version (u8), saved_at (f64)
+    counters count (u32), size (u16), granularity (f64), keys,
+             count * clock (f64), count * size * value (i32)
+    states   count (u32), keys, count * state (u8)
+    streaks  count (u32), keys, count * streak (u32)
+    locks    count (u32), keys, count * status (u8), count * locked_at (f64)
+
+Keys are utf-8 encoded and joined by ``\\n``, prefixed with the length
+(u32). All-zero counters and unlocked apis are not saved.
+"""
+
+import os
+import time
+import struct
+import logging
+import tempfile
+import threading
+
+from .checker import MODE_UNLOCKED
+from ._pack import COUNT, pack_keys, unpack_keys, pack_array, unpack_array
+
+
+MAGIC = b'DRCK'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sBd')
+_COUNTERS = struct.Struct('<Hd')
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def _fit(values, size):
+    # pad or trim on the left (older elements), like `RollingNumber.resize`.
+    if len(values) < size:
+        return [0] * (size - len(values)) + values
+    return values[len(values) - size:]
+
+
+class Checkpoint(object):
+    """
+    Save ``HealthTester`` runtime data to a local file periodically, and
+    restore it on startup, so locked apis stay locked through restarts::
+
+        checkpoint = Checkpoint(tester, '/var/run/doctor/my.service')
+        checkpoint.restore()
+        checkpoint.start()
+
+    Saving runs in a daemon thread (:meth:`start`), off the request path.
+    The file is written to a temporary file then renamed, so a crash never
+    leaves a partial checkpoint.
+
+    Parameters::
+
+    * tester: ``HealthTester`` object.
+    * path: the checkpoint file path.
+    * interval: seconds between two saves in the thread.
+    """
+
+    def __init__(self, tester, path, interval=10):
+        self.tester = tester
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def dumps(self):
+        """Serialize current runtime data to bytes."""
+        metrics = self.tester.metrics
+        size = metrics._rollingsize
+        # copy the containers first, they may be changed by requests.
+        restored = metrics.restored_counters()
+        counters = [(key, counter._clock, counter._values)
+                    for key, counter in list(metrics.counters.items())
+                    if any(counter._values)]
+        states = list(metrics.api_latest_state.items())
+        streaks = list(metrics.api_failure_streak.items())
+        locks = [(key, lock['locked_status'], lock['locked_at'])
+                 for key, lock in list(self.tester.locks.items())
+                 if lock.get('locked_status', MODE_UNLOCKED) != MODE_UNLOCKED]
+
+        counters.extend((key, clock, values) for key, clock, values in restored
+                        if any(values))
+        values = []
+        for _, _, counter_values in counters:
+            if len(counter_values) != size:
+                counter_values = _fit(counter_values, size)
+            values.extend(counter_values)
+        chunks = [_HEADER.pack(MAGIC, VERSION, time.time()),
+                  COUNT.pack(len(counters)),
+                  _COUNTERS.pack(size, metrics._granularity),
+                  pack_keys([c[0] for c in counters]),
+                  pack_array('d', [c[1] for c in counters]),
+                  pack_array('i', values),
+                  COUNT.pack(len(states)),
+                  pack_keys([key for key, _ in states]),
+                  pack_array('B', [bool(state) for _, state in states]),
+                  COUNT.pack(len(streaks)),
+                  pack_keys([key for key, _ in streaks]),
+                  pack_array('I', [streak for _, streak in streaks]),
+                  COUNT.pack(len(locks)),
+                  pack_keys([lock[0] for lock in locks]),
+                  pack_array('B', [lock[1] for lock in locks]),
+                  pack_array('d', [lock[2] for lock in locks])]
+        return b''.join(chunks)
+
+    def loads(self, data):
+        """
+        Restore runtime data from bytes, returns the number of counters
+        restored. Counters are restored by :meth:`Metrics.restore_counters`,
+        their windows are shifted by the time elapsed since saved.
+
+        Raises ``CheckpointError`` if `data` is not a valid checkpoint, in
+        which case nothing is restored.
+        """
+        tester = self.tester
+        metrics = tester.metrics
+        buf = memoryview(data)
+
+        # decode all before restoring anything.
+        try:
+            magic, version, _ = _HEADER.unpack_from(buf, 0)
+            if magic != MAGIC or version != VERSION:
+                raise CheckpointError('Bad checkpoint header')
+            offset = _HEADER.size
+
+            counters, = COUNT.unpack_from(buf, offset)
+            size, granularity = _COUNTERS.unpack_from(buf,
+                                                      offset + COUNT.size)
+            offset += COUNT.size + _COUNTERS.size
+            counter_keys, offset = unpack_keys(buf, offset, counters)
+            clocks, offset = unpack_array('d', buf, offset, counters)
+            values, offset = unpack_array('i', buf, offset, counters * size)
+
+            count, = COUNT.unpack_from(buf, offset)
+            state_keys, offset = unpack_keys(buf, offset + COUNT.size, count)
+            states, offset = unpack_array('B', buf, offset, count)
+
+            count, = COUNT.unpack_from(buf, offset)
+            streak_keys, offset = unpack_keys(buf, offset + COUNT.size, count)
+            streaks, offset = unpack_array('I', buf, offset, count)
+
+            count, = COUNT.unpack_from(buf, offset)
+            lock_keys, offset = unpack_keys(buf, offset + COUNT.size, count)
+            statuses, offset = unpack_array('B', buf, offset, count)
+            locked_ats, offset = unpack_array('d', buf, offset, count)
+        except (struct.error, UnicodeDecodeError, ValueError) as exc:
+            raise CheckpointError('Bad checkpoint: {0}'.format(exc))
+        if (len(counter_keys) != counters or
+                len(values) != counters * size or
+                len(states) != len(state_keys) or
+                len(streaks) != len(streak_keys) or
+                len(locked_ats) != len(lock_keys)):
+            raise CheckpointError('Truncated checkpoint')
+
+        metrics.restore_counters(counter_keys, size, granularity, clocks,
+                                 values)
+        metrics.api_latest_state.update(zip(state_keys, map(bool, states)))
+        metrics.api_failure_streak.update(zip(streak_keys, streaks))
+        for key, status, locked_at in zip(lock_keys, statuses, locked_ats):
+            lock = tester._get_api_lock(key)
+            lock['locked_status'] = status
+            lock['locked_at'] = locked_at
+        return counters
+
+    def save(self):
+        """
+        Save a checkpoint to `path`, via a unique temporary file synced to
+        disk, so processes sharing `path` never write the same file.
+        """
+        data = self.dumps()
+        directory, name = os.path.split(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='{0}.'.format(name),
+                                        suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def restore(self):
+        """
+        Restore the checkpoint from `path`, returns ``False`` if there is no
+        checkpoint file, or if it is not valid (logged), so a bad checkpoint
+        falls back to a cold start.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return False
+        try:
+            self.loads(data)
+        except CheckpointError as exc:
+            logger.error('Failed to restore checkpoint %s: %s', self.path, exc)
+            return False
+        return True
+
+    def start(self):
+        """Start a daemon thread to save checkpoints every `interval`."""
+        if self._thread is not None:
+            raise RuntimeError('Checkpoint is already started')
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, save=True):
+        """Stop the saving thread, and save a last checkpoint if `save`."""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        if save:
+            self.save()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.save()
+            except Exception:
+                logger.exception('Failed to save checkpoint %s', self.path)
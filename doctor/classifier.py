@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+"""
+Classifier
+==========
+
+Classify api call errors into outcomes (``OUTCOME_*`` in ``doctor.metrics``)
+to be recorded by ``APIMetrics.record``.
+"""
+
+from .metrics import OUTCOME_OK, OUTCOME_UNKWN_EXC, OUTCOMES
+
+
+class ExceptionClassifier(object):
+    """
+    Map exceptions to api call outcomes by their types::
+
+        classifier = ExceptionClassifier({
+            OUTCOME_TIMEOUT: (gevent.Timeout, socket.timeout),
+            OUTCOME_SYS_EXC: SysError,
+            OUTCOME_USER_EXC: UserError,
+        })
+        classifier.classify(UserError())  # => OUTCOME_USER_EXC
+        classifier.classify(None)  # => OUTCOME_OK
+
+    The mapping is compiled once into a `type -> outcome` dict. An exception
+    class not in the dict is resolved by its ``__mro__`` (the nearest base
+    class wins), or to `default` if no base class matches, and the result is
+    cached per exception class, so classifying costs one dict lookup in
+    common cases.
+
+    Attributes:
+      default    the outcome of unmatched exceptions (default: unkwn_exc)
+    """
+
+    def __init__(self, mapping=None, default=OUTCOME_UNKWN_EXC):
+        self.default = default
+        self._types = dict()
+        if mapping is not None:
+            for outcome, exc_types in mapping.items():
+                if outcome not in OUTCOMES:
+                    raise ValueError('Unknown outcome: {0!r}'.format(outcome))
+                if not isinstance(exc_types, (tuple, list)):
+                    exc_types = (exc_types,)
+                for exc_type in exc_types:
+                    self._types[exc_type] = outcome
+        self._cache = self._types.copy()
+
+    def classify(self, exc):
+        """
+        Return the outcome of `exc`, an exception instance (or class),
+        ``None`` for ``OUTCOME_OK``.
+        """
+        if exc is None:
+            return OUTCOME_OK
+        exc_type = exc if isinstance(exc, type) else exc.__class__
+        try:
+            return self._cache[exc_type]
+        except KeyError:
+            pass
+
+        outcome = self.default
+        for base in exc_type.__mro__:
+            if base in self._types:
+                outcome = self._types[base]
+                break
+        self._cache[exc_type] = outcome
+        return outcome
+
+    def match(self, exc):
+        """
+        Return the outcome `exc` is mapped to by its type or base classes,
+        ``None`` if not mapped (instead of `default`).
+        """
+        exc_type = exc if isinstance(exc, type) else exc.__class__
+        for base in exc_type.__mro__:
+            if base in self._types:
+                return self._types[base]
+        return None
@@ -20,6 +20,13 @@ class Configs(dict):
             HEALTH_THRESHOLD_TIMEOUT=0.5,  # percentage per `INTERVAL`
             HEALTH_THRESHOLD_SYS_EXC=0.5,  # percentage per `INTERVAL`
             HEALTH_THRESHOLD_UNKWN_EXC=0.5,  # percentage per `INTERVAL`
+            HEALTH_THRESHOLD_CONSECUTIVE_FAILURES=0,  # 0 to disable
+            HEALTH_SERVICE_BREAKER=False,  # lock whole services
+            HEALTH_PRIORITY_WEIGHTS={},  # {priority: weight}, empty to disable
+            HEALTH_DEGRADED_RATIO=0,  # percentage of thresholds, 0 to disable
+            HEALTH_RETRY_BUDGET_RATIO=0,  # retries / requests, 0 to disable
+            HEALTH_RETRY_BUDGET_MIN=10,  # min retries allowed per `INTERVAL`
+            HEALTH_STATS_SAMPLING=0,  # time 1 in N tests, 0 to disable
         )
         super(self.__class__, self).__init__(**defaults)
 
@@ -28,9 +35,9 @@ class Configs(dict):
 
     def load(self, obj):
         if isinstance(obj, dict):
-            items = obj.iteritems()
+            items = obj.items()
         else:
-            items = obj.__dict__.iteritems()
+            items = obj.__dict__.items()
 
         for k, v in items:
             if k in self:
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+"""
+Fallback
+========
+
+A bounded LRU/TTL cache of the last good responses of idempotent read apis,
+served instead of an error while an api is refused by ``HealthTester.test``,
+see ``doctor.plugins.client.api_call``::
+
+    fallback = FallbackCache(max_entries=1000, ttl=300)
+
+    @api_call(tester, 'user.service', fallback=fallback)
+    def get_user(user_id):
+        return client.get_user(user_id)
+
+Responses are keyed by the api and its arguments, arguments are normalized
+(lists as tuples, dicts and sets unordered), calls with arguments that can
+not be normalized into a hashable key are not cached.
+"""
+
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return frozenset((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
+    return value
+
+
+class FallbackCache(object):
+    """
+    Parameters::
+
+    * max_entries: max responses kept, least recently used ones are evicted.
+    * ttl: seconds to serve a response after it is stored, ``None`` to
+      serve it until evicted.
+    * max_bytes: max total size of responses kept, ``None`` for no limit,
+      responses larger than it are not kept.
+    * sizeof: callable to get the size of a response in bytes, default to
+      ``sys.getsizeof``, which does not count the objects referred.
+    * key_func: callable to get the cache key from ``(args, kwargs)`` of a
+      call, i.e. to drop arguments not affecting the response, default to
+      all the arguments normalized.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60, max_bytes=None,
+                 sizeof=sys.getsizeof, key_func=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.key_func = key_func
+
+        # {key: (expires_at, size, value)}, least recently used first.
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def make_key(self, service_name, func_name, args, kwargs):
+        """
+        Return the cache key of a call, ``None`` if the arguments can not be
+        normalized into a hashable key (the call is not cached then).
+        """
+        try:
+            if self.key_func is not None:
+                params = self.key_func(args, kwargs)
+            else:
+                params = (_freeze(args), _freeze(kwargs))
+            key = (service_name, func_name, params)
+            hash(key)
+        except (TypeError, ValueError):
+            return None
+        return key
+
+    def set(self, key, value):
+        """Store the response `value` of `key`."""
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires_at = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+            self._entries[key] = (expires_at, size, value)
+            self._bytes += size
+            self._stores += 1
+            while (len(self._entries) > self.max_entries or
+                   (self.max_bytes is not None and
+                    self._bytes > self.max_bytes)):
+                _, entry = self._entries.popitem(last=False)
+                self._bytes -= entry[1]
+                self._evictions += 1
+
+    def get(self, key, default=None):
+        """
+        Return the response stored of `key`, `default` if not found or
+        expired.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return default
+            expires_at, size, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._bytes -= size
+                self._misses += 1
+                self._expirations += 1
+                return default
+            # most recently used last.
+            self._entries[key] = entry
+            self._hits += 1
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def snapshot(self):
+        """
+        Return the cache stats as a dict, keys: ``entries``, ``bytes``,
+        ``hits``, ``misses``, ``stores``, ``evictions``, ``expirations``.
+        """
+        return {'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'stores': self._stores,
+                'evictions': self._evictions,
+                'expirations': self._expirations}
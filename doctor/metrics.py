@@ -20,6 +20,22 @@ Features
 import time
 
 
+# Pseudo function name to aggregate metrics of all apis in a service.
+SERVICE_FUNC_NAME = '*'
+
+# Expiry of cached healthy verdicts of error-free apis, see `healthy_apis`.
+HEALTHY_FOREVER = float('inf')
+
+# Api call outcomes.
+OUTCOME_OK = 'ok'
+OUTCOME_USER_EXC = 'user_exc'
+OUTCOME_TIMEOUT = 'timeout'
+OUTCOME_SYS_EXC = 'sys_exc'
+OUTCOME_UNKWN_EXC = 'unkwn_exc'
+OUTCOMES = (OUTCOME_OK, OUTCOME_USER_EXC, OUTCOME_TIMEOUT, OUTCOME_SYS_EXC,
+            OUTCOME_UNKWN_EXC)
+
+
 class RollingNumber(object):
     """
     RollingNumber behaves like a FIFO queue with fixed length, or a
@@ -45,15 +61,22 @@ class RollingNumber(object):
       rolling_granularity    the shifting timestamp granularity (default: 1s)
     """
 
-    def __init__(self, rolling_size, rolling_granularity=1):
+    def __init__(self, rolling_size, rolling_granularity=1, shifts=None):
         """
-        Init a rolling number to 0 with size.
+        Init a rolling number to 0 with size. `shifts` is a one-element list
+        shared by rolling numbers to count their shifts on clock changes,
+        i.e. by ``Metrics``.
         """
         self.rolling_size = rolling_size
         self.rolling_granularity = rolling_granularity
+        self._shifts = shifts
 
         self._clock = time.time()
         self._values = [0] * rolling_size
+        # sum of `_values`, maintained on writes so `value()` costs O(1).
+        self._sum = 0
+        # all-time increments, never shifted.
+        self._total = 0
 
     def clear(self):
         """
@@ -63,27 +86,36 @@ class RollingNumber(object):
         set the rolling number to zero.
         """
         self._values = [0] * self.rolling_size
+        self._sum = 0
 
     def value(self):
         """
         Return the value this rolling number present, actually the ``sum()``
-        value of this queue.
+        value of this queue, which is maintained on writes.
         """
         self.shift_on_clock_changes()
-        return sum(self._values)
+        return self._sum
 
     __int__ = value
 
-    def increment(self, value):
+    def increment(self, value, now=None):
         """
         Increment this number by `value`, will increment the last element by ``
-        value``.
+        value``. `now` is the timestamp to shift to, callers incrementing many
+        numbers at once may read the clock once and pass it.
         """
-        self.shift_on_clock_changes()
+        self.shift_on_clock_changes(now)
         self._values[-1] += value
+        self._sum += value
+        self._total += value
 
     incr = increment
 
+    @property
+    def total(self):
+        """The sum of all increments since created, never rolls."""
+        return self._total
+
     def shift(self, length):
         """
         Shift the rolling number to the right by ``length``, will pop elements
@@ -96,19 +128,42 @@ class RollingNumber(object):
             return self.clear()
 
         end = [0] * length
+        self._sum -= sum(self._values[:length])
         self._values = self._values[length:] + end
 
-    def shift_on_clock_changes(self):
+    def resize(self, rolling_size, rolling_granularity=None):
+        """
+        Resize the rolling number in place. Growing fills ``0`` on the left,
+        shrinking pops the oldest elements on the left, elements in the new
+        window are kept. If ``rolling_granularity`` changes, elements are
+        kept as they are and shifted by the new granularity from now on.
+        """
+        self.shift_on_clock_changes()
+        if rolling_granularity is not None:
+            self.rolling_granularity = rolling_granularity
+        if rolling_size > self.rolling_size:
+            self._values = ([0] * (rolling_size - self.rolling_size) +
+                            self._values)
+        elif rolling_size < self.rolling_size:
+            self._values = self._values[self.rolling_size - rolling_size:]
+        self.rolling_size = rolling_size
+        # `_values` may be set directly before, i.e. by restoring.
+        self._sum = sum(self._values)
+
+    def shift_on_clock_changes(self, now=None):
         """
         Shift the rolling number if its ``_clock`` is bebind the timestamp
         ``now`` by at least 1 timestamp granularity, and synchronous its
         ``_clock`` to ``now``.
         """
-        now = time.time()
+        if now is None:
+            now = time.time()
         length = int((now - self._clock) // self.rolling_granularity)
         if length > 0:
             self.shift(length)
             self._clock = now
+            if self._shifts is not None:
+                self._shifts[0] += 1
 
     def __repr__(self):
         """
@@ -122,15 +177,35 @@ class Metrics(object):
     def __init__(self, settings):
         self._granularity = settings.METRICS_GRANULARITY
         self._rollingsize = settings.METRICS_ROLLINGSIZE
+        self._service_breaker = settings.HEALTH_SERVICE_BREAKER
 
         self._api_latest_state = dict()
+        self._api_failure_streak = dict()
+        self._healthy_apis = dict()
         self._counters = dict()
+        self._apis = dict()
+        # counters aggregated across processes, see `update_remote`.
+        self._remote = dict()
+        self._remote_locks = set()
+        # counters restored lazily, see `restore_counters`.
+        self._restored = dict()
+        self._restored_data = None
+        # shifts of all counters, shared with them.
+        self._shifts = [0]
 
     @property
     def counters(self):
-        """``RollingNumber`` object."""
+        """
+        ``RollingNumber`` objects by keys, counters restored but not
+        accessed yet are not included (see :meth:`restore_counters`).
+        """
         return self._counters
 
+    @property
+    def window_shifts(self):
+        """The number of shifts of all counters on clock changes."""
+        return self._shifts[0]
+
     @property
     def api_latest_state(self):
         """
@@ -141,41 +216,390 @@ class Metrics(object):
         """
         return self._api_latest_state
 
+    @property
+    def api_failure_streak(self):
+        """
+        A dict to record the count of consecutive failed api calls, schema:
+        `{api_name: count}`. Timeouts and sys_excs increment the count, calls
+        succeed without any errors (except the `too_busy_exception`) reset it
+        to `0`, unkwn_excs leave it untouched.
+        """
+        return self._api_failure_streak
+
+    @property
+    def healthy_apis(self):
+        """
+        A dict to cache the apis known to be healthy, schema:
+        `{api_name: expires_at}`. An api is cached if it has no errors in
+        current rolling window (until ``HEALTHY_FOREVER``), or if it has
+        more requests than `THRESHOLD_REQUEST` with error ratios under the
+        thresholds (until its requests window shifts). New requests can only
+        keep such apis healthy, the verdict is discarded once an error is
+        recorded by the ``on_api_called_*`` hooks.
+
+        *Note*: errors counted by :meth:`incr` directly bypass this cache.
+        """
+        return self._healthy_apis
+
+    def reload(self, settings):
+        """
+        Reload settings on the fly, resize all counters in place (see
+        :meth:`RollingNumber.resize`) and re-resolve ``APIMetrics`` handles,
+        handles held by callers keep working.
+        """
+        self._granularity = settings.METRICS_GRANULARITY
+        self._rollingsize = settings.METRICS_ROLLINGSIZE
+        self._service_breaker = settings.HEALTH_SERVICE_BREAKER
+        for counter in list(self._counters.values()):
+            counter.resize(self._rollingsize, self._granularity)
+        for api in list(self._apis.values()):
+            api.resolve(self)
+
+    def _counter(self, key):
+        counter = self._counters.get(key, None)
+        if counter is None:
+            if self._restored:
+                counter = self._restore_counter(key)
+            if counter is None:
+                counter = self._counters.setdefault(key, RollingNumber(
+                    self._rollingsize, rolling_granularity=self._granularity,
+                    shifts=self._shifts))
+        return counter
+
+    def restore_counters(self, keys, rolling_size, rolling_granularity,
+                         clocks, values):
+        """
+        Restore counters saved by ``doctor.checkpoint``. `keys` are the
+        counter keys, `clocks` their ``_clock``, `values` their elements
+        concatenated, `rolling_size` elements per counter.
+
+        Existing counters are restored in place at once, others lazily on
+        their first access, to keep restoring cheap. A restored counter is
+        shifted by the time elapsed since its clock, then resized to current
+        settings.
+        """
+        self._restored_data = (rolling_size, rolling_granularity, clocks,
+                               values)
+        self._restored = dict(zip(keys, range(len(keys))))
+        for key in [key for key in self._counters if key in self._restored]:
+            self._restore_counter(key)
+        self._healthy_apis.clear()
+
+    def restored_counters(self):
+        """
+        Return a list of ``(key, clock, values)`` of the counters restored
+        but not accessed yet.
+        """
+        if not self._restored:
+            return []
+        size, _, clocks, values = self._restored_data
+        return [(key, clocks[index],
+                 values[index * size:(index + 1) * size].tolist())
+                for key, index in list(self._restored.items())]
+
+    def _restore_counter(self, key):
+        index = self._restored.pop(key, None)
+        if index is None:
+            return None
+        size, granularity, clocks, values = self._restored_data
+        counter = self._counters.get(key, None)
+        if counter is None:
+            counter = RollingNumber(size, rolling_granularity=granularity,
+                                    shifts=self._shifts)
+        counter.rolling_size = size
+        counter.rolling_granularity = granularity
+        counter._values = values[index * size:(index + 1) * size].tolist()
+        counter._clock = clocks[index]
+        counter.resize(self._rollingsize, self._granularity)
+        return self._counters.setdefault(key, counter)
+
+    def next_shift_at(self, key):
+        """
+        Return the time when the value of `key` may drop next, by its window
+        shift or by the expiry of its aggregated value, ``0`` if unknown.
+        """
+        counter = self._counters.get(key, None)
+        if counter is None:
+            return 0
+        at = counter._clock + counter.rolling_granularity
+        remote = self._remote.get(key, None) if self._remote else None
+        if remote is not None:
+            at = min(at, remote[2])
+        return at
+
     def incr(self, key, value=1):
         """increment the counter value by ``value``, if the
         counter was not found, create one and increment it.
         """
-        if key not in self._counters:
-            self._counters[key] = RollingNumber(
-                self._rollingsize, rolling_granularity=self._granularity)
-        counter = self._counters[key]
-        counter.incr(value)
+        self._counter(key).incr(value)
 
     def get(self, key, default=0):
         """Get metric value by `key`, if not found ,return default."""
         v = self._counters.get(key, None)
+        if v is None and self._restored:
+            v = self._restore_counter(key)
+        if self._remote:
+            remote = self._remote.get(key, None)
+            if remote is not None:
+                value, sent_total, expires_at = remote
+                if time.time() < expires_at:
+                    # aggregated value plus local increments not sent yet.
+                    return value + ((v and v.total) or 0) - sent_total
         return (v and v.value()) or default
 
-    def on_api_called(self, service_name, func_name):
-        self.incr('{0}.{1}'.format(service_name, func_name))
+    @property
+    def remote_locks(self):
+        """
+        A set of api keys locked by other processes, reported by the
+        aggregator, see ``doctor.aggregator``.
+        """
+        return self._remote_locks
+
+    def update_remote(self, values, sent_totals, expires_at, locks=None):
+        """
+        Blend counter values aggregated across processes (i.e. by
+        ``doctor.aggregator``) into :meth:`get` until `expires_at`.
+
+        `values` are ``{key: aggregated value}``, `sent_totals` are
+        ``{key: local counter total}`` when the increments included in the
+        aggregated values were sent, local increments after are added to the
+        aggregated values. `locks` replaces :attr:`remote_locks` if given.
+        """
+        for key, value in values.items():
+            self._remote[key] = (value, sent_totals.get(key, 0), expires_at)
+        if locks is not None:
+            self._remote_locks.intersection_update(locks)
+            self._remote_locks.update(locks)
+        # aggregated errors invalidate cached verdicts.
+        self._healthy_apis.clear()
+
+    def clear_remote(self):
+        """Drop all aggregated values and locks, back to local only."""
+        self._remote.clear()
+        self._remote_locks.clear()
+        self._healthy_apis.clear()
+
+    def api(self, service_name, func_name):
+        """
+        Get the ``APIMetrics`` handle of an api, create one if not found.
+        Callers on hot paths may keep the handle to skip this lookup.
+        """
+        api = self._apis.get((service_name, func_name), None)
+        if api is None:
+            api = self._apis[(service_name, func_name)] = APIMetrics(
+                self, service_name, func_name)
+        return api
+
+    def record_batch(self, service_name, func_name, ok=0, user_exc=0,
+                     timeout=0, sys_exc=0, unkwn_exc=0, last=None, retries=0):
+        """
+        Record a batch of calls on an api with their outcome counts at once,
+        i.e. sub-calls of a pipelined round-trip, see
+        :meth:`APIMetrics.record_batch`.
+        """
+        self.api(service_name, func_name).record_batch(
+            ok, user_exc, timeout, sys_exc, unkwn_exc, last, retries=retries)
+
+    def record_batches(self, batches):
+        """
+        Record batches of calls on many apis, `batches` is an iterable of
+        ``(service_name, func_name, counts)``, `counts` is a dict of the
+        keyword arguments of :meth:`record_batch`. The clock is read once for
+        all batches.
+        """
+        now = time.time()
+        for service_name, func_name, counts in batches:
+            self.api(service_name, func_name).record_batch(now=now, **counts)
+
+    def on_api_called(self, service_name, func_name, retry=False):
+        self.api(service_name, func_name).called(retry)
 
     def on_api_called_ok(self, service_name, func_name):
-        self._api_latest_state['{0}.{1}'.format(service_name,
-                                                func_name)] = True
+        self.api(service_name, func_name).called_ok()
 
     def on_api_called_user_exc(self, service_name, func_name):
-        self._api_latest_state['{0}.{1}'.format(service_name,
-                                                func_name)] = True
+        self.api(service_name, func_name).called_user_exc()
 
     def on_api_called_timeout(self, service_name, func_name):
-        self.incr('{0}.{1}.timeout'.format(service_name, func_name))
+        self.api(service_name, func_name).called_timeout()
 
     def on_api_called_sys_exc(self, service_name, func_name):
-        self.incr('{0}.{1}.sys_exc'.format(service_name, func_name))
-        self._api_latest_state['{0}.{1}'.format(service_name,
-                                                func_name)] = False
+        self.api(service_name, func_name).called_sys_exc()
 
     def on_api_called_unkwn_exc(self, service_name, func_name):
-        self.incr('{0}.{1}.unkwn_exc'.format(service_name, func_name))
-        self._api_latest_state['{0}.{1}'.format(service_name,
-                                                func_name)] = False
+        self.api(service_name, func_name).called_unkwn_exc()
+
+
+class APIMetrics(object):
+    """
+    Metrics handle of one api, returned by :meth:`Metrics.api`. The metric
+    keys are formatted and the ``RollingNumber`` counters are resolved once
+    on creation, so recording through a handle costs no key formatting nor
+    counter lookups. If `SERVICE_BREAKER` is enabled, the service aggregated
+    metrics are recorded as well.
+
+    Calls recorded with ``retry=True`` are retries of failed calls, they are
+    counted as requests, and also counted in ``service.func.retry`` for the
+    retry budget (see ``HealthTester.can_retry``).
+
+    Attributes:
+      key            the api metric key, ``service.func``
+      service_key    the service aggregated metric key, ``service.*``,
+                     ``None`` if `SERVICE_BREAKER` is disabled
+    """
+    __slots__ = ['service_name', 'func_name', 'key', 'service_key',
+                 '_entries', '_retries', '_latest_state', '_failure_streak',
+                 '_healthy_apis']
+
+    def __init__(self, metrics, service_name, func_name):
+        self.service_name = service_name
+        self.func_name = func_name
+        self.key = '{0}.{1}'.format(service_name, func_name)
+        self.resolve(metrics)
+
+    def resolve(self, metrics):
+        """(Re-)resolve the metric keys and counters from `metrics`."""
+        self.service_key = None
+        keys = [self.key]
+        if metrics._service_breaker:
+            self.service_key = '{0}.{1}'.format(self.service_name,
+                                                SERVICE_FUNC_NAME)
+            keys.append(self.service_key)
+
+        # (key, requests, timeouts, sys_excs, unkwn_excs) per key.
+        self._entries = tuple(
+            (key, metrics._counter(key),
+             metrics._counter('{0}.timeout'.format(key)),
+             metrics._counter('{0}.sys_exc'.format(key)),
+             metrics._counter('{0}.unkwn_exc'.format(key)))
+            for key in keys)
+        self._retries = tuple(metrics._counter('{0}.retry'.format(key))
+                              for key in keys)
+        self._latest_state = metrics.api_latest_state
+        self._failure_streak = metrics.api_failure_streak
+        self._healthy_apis = metrics.healthy_apis
+
+    def called(self, retry=False):
+        for entry in self._entries:
+            entry[1].incr(1)
+        if retry:
+            for retries in self._retries:
+                retries.incr(1)
+
+    def called_ok(self):
+        for entry in self._entries:
+            self._latest_state[entry[0]] = True
+            self._failure_streak[entry[0]] = 0
+
+    called_user_exc = called_ok
+
+    def called_timeout(self):
+        for key, _, timeouts, _, _ in self._entries:
+            timeouts.incr(1)
+            self._healthy_apis.pop(key, None)
+            self._failure_streak[key] = self._failure_streak.get(key, 0) + 1
+
+    def called_sys_exc(self):
+        for key, _, _, sys_excs, _ in self._entries:
+            sys_excs.incr(1)
+            self._healthy_apis.pop(key, None)
+            self._latest_state[key] = False
+            self._failure_streak[key] = self._failure_streak.get(key, 0) + 1
+
+    def called_unkwn_exc(self):
+        for key, _, _, _, unkwn_excs in self._entries:
+            unkwn_excs.incr(1)
+            self._healthy_apis.pop(key, None)
+            self._latest_state[key] = False
+
+    def record(self, outcome, retry=False):
+        """
+        Record an api call with its `outcome`, one of the ``OUTCOME_*``
+        constants, same to :meth:`called` plus the ``called_*`` method of
+        the outcome.
+        """
+        for entry in self._entries:
+            entry[1].incr(1)
+        if retry:
+            for retries in self._retries:
+                retries.incr(1)
+        _OUTCOME_RECORDERS[outcome](self)
+
+    def record_batch(self, ok=0, user_exc=0, timeout=0, sys_exc=0,
+                     unkwn_exc=0, last=None, now=None, retries=0):
+        """
+        Record a batch of calls with their outcome counts at once, each
+        counter is shifted once with the clock read once. `retries` is how
+        many of the calls are retries.
+
+        The order of the calls in a batch is unknown, so failures in a
+        batch with any successes (ok or user_exc) never make a failure
+        streak: the streak is reset and the latest state is set by the
+        successes. A batch that failed as a whole extends the streak and
+        sets the latest state like recording its failures one by one.
+
+        If the outcome of the `last` call is given, latest state and failure
+        streak end up the same as recording the calls one by one in the
+        order of ok, user_exc, unkwn_exc, timeout and sys_exc, with the
+        `last` outcome moved to the end.
+        """
+        requests = ok + user_exc + timeout + sys_exc + unkwn_exc
+        if not requests:
+            return
+        if now is None:
+            now = time.time()
+        counts = None
+        if last is not None:
+            counts = sorted(((OUTCOME_OK, ok), (OUTCOME_USER_EXC, user_exc),
+                             (OUTCOME_UNKWN_EXC, unkwn_exc),
+                             (OUTCOME_TIMEOUT, timeout),
+                             (OUTCOME_SYS_EXC, sys_exc)),
+                            key=lambda count: count[0] == last)
+        if retries:
+            for retries_ in self._retries:
+                retries_.incr(retries, now)
+
+        for key, requests_, timeouts, sys_excs, unkwn_excs in self._entries:
+            requests_.incr(requests, now)
+            if timeout:
+                timeouts.incr(timeout, now)
+            if sys_exc:
+                sys_excs.incr(sys_exc, now)
+            if unkwn_exc:
+                unkwn_excs.incr(unkwn_exc, now)
+            if timeout or sys_exc or unkwn_exc:
+                self._healthy_apis.pop(key, None)
+
+            state = self._latest_state.get(key, None)
+            streak = self._failure_streak.get(key, 0)
+            if counts is None:
+                if ok or user_exc:
+                    state, streak = True, 0
+                else:
+                    streak += timeout + sys_exc
+                    if sys_exc or unkwn_exc:
+                        state = False
+            else:
+                for outcome, count in counts:
+                    if not count:
+                        continue
+                    if outcome == OUTCOME_OK or outcome == OUTCOME_USER_EXC:
+                        state, streak = True, 0
+                    elif outcome == OUTCOME_TIMEOUT:
+                        streak += count
+                    elif outcome == OUTCOME_SYS_EXC:
+                        state, streak = False, streak + count
+                    else:
+                        state = False
+            if state is not None:
+                self._latest_state[key] = state
+            self._failure_streak[key] = streak
+
+
+_OUTCOME_RECORDERS = {
+    OUTCOME_OK: APIMetrics.called_ok,
+    OUTCOME_USER_EXC: APIMetrics.called_user_exc,
+    OUTCOME_TIMEOUT: APIMetrics.called_timeout,
+    OUTCOME_SYS_EXC: APIMetrics.called_sys_exc,
+    OUTCOME_UNKWN_EXC: APIMetrics.called_unkwn_exc,
+}
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+"""
+Coroutine version of ``doctor.plugins.client.api_call`` wrappers, kept
+apart as ``async def`` is a syntax error on Python 2.
+"""
+
+from __future__ import absolute_import
+
+import functools
+
+from ..metrics import OUTCOME_OK
+from .client import rejected_result
+
+
+def wrap_coroutine_function(func, recorder, service_name, func_name, api,
+                            on_rejected, fallback=None):
+    @functools.wraps(func)
+    async def _wrapper(*args, **kwargs):
+        key = None
+        if fallback is not None:
+            key = fallback.make_key(service_name, func_name, args, kwargs)
+        if not recorder.test(api):
+            return rejected_result(fallback, key, on_rejected, args, kwargs)
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as exc:
+            recorder.record(api, exc)
+            raise
+        api.record(OUTCOME_OK)
+        if key is not None:
+            fallback.set(key, result)
+        return result
+    return _wrapper
@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import socket
 import logging
-from .. import HealthTester, Configs
+
+from .. import HealthTester, Configs, ExceptionClassifier
+from ..metrics import OUTCOME_TIMEOUT
+from .recorder import CallRecorder
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
 
 logger = logging.getLogger(__name__)
 
@@ -14,16 +23,45 @@ EXPORTED_CALLBACKS = [
     "on_api_health_tested_ok",
     ]
 
+# Default `{outcome: exception types}` mapping, exceptions not matched are
+# recorded as `unkwn_exc`.
+DEFAULT_OUTCOMES = {
+    OUTCOME_TIMEOUT: (socket.timeout,) + ((gevent.Timeout,) if gevent else ()),
+    }
+
+
 class Doctor(object):
-    def __init__(self, failure_exception, settings=None):
+    """
+    Parameters::
+
+    * failure_exception: exception to raise if the api is not healthy.
+    * settings: settings to load into ``Configs``.
+    * outcomes: ``{outcome: exception types}`` mapping to classify the api
+      call errors, or an ``ExceptionClassifier``, default to
+      ``DEFAULT_OUTCOMES``.
+    """
+    def __init__(self, failure_exception, settings=None, outcomes=None):
         self.configs = Configs(settings)
         self.app = None
         self.tester = None
         self.failure_exception = failure_exception
+        if isinstance(outcomes, ExceptionClassifier):
+            self.classifier = outcomes
+        else:
+            self.classifier = ExceptionClassifier(
+                DEFAULT_OUTCOMES if outcomes is None else outcomes)
+        self.recorder = None
+        self._apis = {}
+
+    def _api(self, api_meta):
+        api = self._apis.get(api_meta.name, None)
+        if api is None:
+            api = self._apis[api_meta.name] = self.recorder.api(
+                api_meta.app.service_name, api_meta.name)
+        return api
 
     def test(self, app_meta):
-        app, func_name = app_meta.app, app_meta.name
-        if not self.tester.test(app.service_name, func_name):
+        if not self.tester.test_api(self._api(app_meta)):
             raise self.failure_exception
 
     def init_app(self, app):
@@ -37,19 +75,19 @@ class Doctor(object):
             self.on_api_health_tested_bad,
             self.on_api_health_tested_ok,
             )
+        self.recorder = CallRecorder(self.tester, self.classifier)
         self.app = app
         self.app.before_api_call(self.test)
         self.app.tear_down_api_call(self.collect_api_call_result)
 
-    def collect_api_call_result(self, api_meta, result_meta):
-        service_name, func_name = api_meta.app.service_name, api_meta.name
-        self.tester.metrics.on_api_called(service_name, func_name)
-        if result_meta.error is None:
-            self.tester.metrics.on_api_called_ok(service_name, func_name)
-        else:
-            self.tester.metrics.on_api_called_unkwn_exc(service_name,
-                                                        func_name)
+    def reload(self, settings):
+        """Reload `settings` on the fly, see ``HealthTester.reload``."""
+        self.configs.load(settings)
+        if self.tester is not None:
+            self.tester.reload(self.configs)
 
+    def collect_api_call_result(self, api_meta, result_meta):
+        self.recorder.record(self._api(api_meta), result_meta.error)
 
     def set_handler(self, name, func):
         if name not in EXPORTED_CALLBACKS:
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from .recorder import CallRecorder, status_outcome
+
+
+def path_func_name(scope):
+    """
+    Api name of an ASGI request by its ``path``, only for apps without ids
+    in paths, as metrics are kept for every distinct name.
+    """
+    return scope.get('path', '')
+
+
+class DoctorASGIMiddleware(object):
+    """
+    ASGI middleware to test api health before the request enters `app`,
+    and record the call result after::
+
+        app = DoctorASGIMiddleware(app, tester, 'my.service', route_name)
+
+    Only ``http`` scopes are tested, others are passed to `app` directly.
+    Requests on a locked api are refused with the reject response, `app`
+    is not called at all. Errors raised by `app` are classified by the
+    classifier, responses are classified by their status (5xx as
+    ``sys_exc`` by default).
+
+    Parameters are the same to ``doctor.plugins.wsgi.DoctorMiddleware``,
+    except that `func_name` takes the ASGI `scope`, and `reject_status` is
+    an int.
+    """
+
+    def __init__(self, app, tester, service_name, func_name, classifier=None,
+                 status_outcome=status_outcome,
+                 reject_status=503,
+                 reject_headers=((b'content-type', b'text/plain'),),
+                 reject_body=b'Service Unavailable'):
+        self.app = app
+        self.recorder = CallRecorder(tester, classifier)
+        self.service_name = service_name
+        self.func_name = func_name
+        self.status_outcome = status_outcome
+        self.reject_start = {
+            'type': 'http.response.start',
+            'status': reject_status,
+            'headers': list(reject_headers) + [
+                (b'content-length', str(len(reject_body)).encode('ascii'))],
+        }
+        self.reject_body = {'type': 'http.response.body', 'body': reject_body}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        recorder = self.recorder
+        api = recorder.api(self.service_name, self.func_name(scope))
+        if not recorder.test(api):
+            await send(self.reject_start)
+            await send(self.reject_body)
+            return
+
+        statuses = []
+
+        async def _send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        except BaseException as exc:
+            recorder.record(api, exc)
+            raise
+
+        if statuses:
+            api.record(self.status_outcome(statuses[-1]))
+        else:
+            recorder.record(api)
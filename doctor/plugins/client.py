@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import functools
+
+from ..metrics import OUTCOME_OK
+from .recorder import CallRecorder
+
+try:
+    from inspect import iscoroutinefunction
+except ImportError:
+    def iscoroutinefunction(func):
+        return False
+
+_MISSING = object()
+
+
+def rejected_result(fallback, key, on_rejected, args, kwargs):
+    """
+    Return the result of a rejected call, the response in `fallback` cache
+    of `key` if any, else ``on_rejected(*args, **kwargs)``.
+    """
+    if key is not None:
+        result = fallback.get(key, _MISSING)
+        if result is not _MISSING:
+            return result
+    if on_rejected is None:
+        return None
+    return on_rejected(*args, **kwargs)
+
+
+def api_call(tester, service_name, func_name=None, classifier=None,
+             on_rejected=None, fallback=None):
+    """
+    Decorator to test api health before calling the decorated function, and
+    record the call result after, works on both functions and coroutine
+    functions::
+
+        @api_call(tester, 'user.service', classifier={
+            'user_exc': UserError,
+            'timeout': TimeoutError,
+            'sys_exc': SysError,
+        })
+        def get_user(user_id):
+            return client.get_user(user_id)
+
+    Calls on a locked api return ``on_rejected(*args, **kwargs)`` without
+    calling the function (``None`` if `on_rejected` is not set), which may
+    raise an exception instead. Errors raised by the function are recorded
+    and re-raised.
+
+    If `fallback` is set, the results of successful calls are stored in it,
+    rejected calls return the stored result of the same arguments instead,
+    if any and not expired. Use it on idempotent read apis only.
+
+    Parameters::
+
+    * tester: ``HealthTester`` object.
+    * service_name: the service name of the api.
+    * func_name: the api name, default to the function ``__name__``.
+    * classifier: ``ExceptionClassifier`` or ``{outcome: exception types}``.
+    * on_rejected: callable to get the return value of rejected calls.
+    * fallback: ``doctor.fallback.FallbackCache`` object.
+    """
+    recorder = CallRecorder(tester, classifier)
+
+    def decorator(func):
+        name = func_name or func.__name__
+        api = recorder.api(service_name, name)
+
+        if iscoroutinefunction(func):
+            from ._aio import wrap_coroutine_function
+            return wrap_coroutine_function(func, recorder, service_name,
+                                           name, api, on_rejected, fallback)
+
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            key = None
+            if fallback is not None:
+                key = fallback.make_key(service_name, name, args, kwargs)
+            if not recorder.test(api):
+                return rejected_result(fallback, key, on_rejected, args,
+                                       kwargs)
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as exc:
+                recorder.record(api, exc)
+                raise
+            api.record(OUTCOME_OK)
+            if key is not None:
+                fallback.set(key, result)
+            return result
+        return _wrapper
+    return decorator
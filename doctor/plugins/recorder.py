@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from ..classifier import ExceptionClassifier
+from ..metrics import OUTCOME_OK, OUTCOME_SYS_EXC
+
+
+def status_outcome(status):
+    """
+    Default outcome of a HTTP response `status` (int or WSGI status line),
+    ``5xx`` for ``sys_exc``, others for ``ok``.
+    """
+    if not isinstance(status, int):
+        status = int(status[:3])
+    if status >= 500:
+        return OUTCOME_SYS_EXC
+    return OUTCOME_OK
+
+
+class CallRecorder(object):
+    """
+    The recording path shared by the integrations (archer plugin, WSGI,
+    ASGI middlewares and the client decorator): test an api with the
+    ``HealthTester``, then classify and record the call result on the
+    cached per-api ``APIMetrics`` handle.
+
+    Parameters::
+
+    * tester: ``HealthTester`` object.
+    * classifier: ``ExceptionClassifier`` object, or a ``{outcome:
+      exception types}`` mapping to build one, exceptions not matched are
+      recorded as ``unkwn_exc``.
+    """
+
+    def __init__(self, tester, classifier=None):
+        self.tester = tester
+        if not isinstance(classifier, ExceptionClassifier):
+            classifier = ExceptionClassifier(classifier)
+        self.classifier = classifier
+
+    def api(self, service_name, func_name):
+        """Get the ``APIMetrics`` handle of an api."""
+        return self.tester.metrics.api(service_name, func_name)
+
+    def test(self, api):
+        """Test an `api` handle, same to ``HealthTester.test_api``."""
+        return self.tester.test_api(api)
+
+    def record(self, api, exc=None):
+        """
+        Record a call on `api` handle, `exc` is the error raised. Errors not
+        derived from ``Exception`` (i.e. ``asyncio.CancelledError``,
+        ``KeyboardInterrupt``) are recorded only if the classifier maps
+        their types explicitly (i.e. ``gevent.Timeout``), others are not
+        results of the api and the call is not recorded at all.
+        """
+        if exc is not None and not isinstance(exc, Exception):
+            outcome = self.classifier.match(exc)
+            if outcome is not None:
+                api.record(outcome)
+            return
+        api.record(self.classifier.classify(exc))
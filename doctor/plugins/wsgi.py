@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from .recorder import CallRecorder, status_outcome
+
+
+def path_func_name(environ):
+    """
+    Api name of a WSGI request by its ``PATH_INFO``, only for apps without
+    ids in paths, as metrics are kept for every distinct name.
+    """
+    return environ.get('PATH_INFO', '')
+
+
+class DoctorMiddleware(object):
+    """
+    WSGI middleware to test api health before the request enters `app`,
+    and record the call result after::
+
+        app = DoctorMiddleware(app, tester, 'my.service', route_name)
+
+    Requests on a locked api are refused with the reject response, `app`
+    is not called at all. Errors raised by `app` are classified by the
+    classifier, responses are classified by their status (5xx as
+    ``sys_exc`` by default).
+
+    Parameters::
+
+    * app: the WSGI application.
+    * tester: ``HealthTester`` object.
+    * service_name: the service name of `app`.
+    * func_name: callable to get the api name from the WSGI `environ`,
+      i.e. its route name. Metrics are kept for every distinct name and
+      never freed, so names must be bounded, not raw paths with ids (see
+      ``path_func_name``). Return a single name to break the whole app as
+      one api.
+    * classifier: ``ExceptionClassifier`` or ``{outcome: exception types}``.
+    * status_outcome: callable to get the outcome of a response status.
+    * reject_status, reject_headers, reject_body: the reject response.
+
+    *Note*: errors raised when iterating the response body are not
+    recorded.
+    """
+
+    def __init__(self, app, tester, service_name, func_name, classifier=None,
+                 status_outcome=status_outcome,
+                 reject_status='503 Service Unavailable',
+                 reject_headers=(('Content-Type', 'text/plain'),),
+                 reject_body=b'Service Unavailable'):
+        self.app = app
+        self.recorder = CallRecorder(tester, classifier)
+        self.service_name = service_name
+        self.func_name = func_name
+        self.status_outcome = status_outcome
+        self.reject_status = reject_status
+        self.reject_headers = list(reject_headers)
+        self.reject_body = reject_body
+
+    def __call__(self, environ, start_response):
+        recorder = self.recorder
+        api = recorder.api(self.service_name, self.func_name(environ))
+        if not recorder.test(api):
+            headers = self.reject_headers + [
+                ('Content-Length', str(len(self.reject_body)))]
+            start_response(self.reject_status, headers)
+            return [self.reject_body]
+
+        statuses = []
+
+        def _start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = self.app(environ, _start_response)
+        except BaseException as exc:
+            recorder.record(api, exc)
+            raise
+
+        if statuses:
+            api.record(self.status_outcome(statuses[-1]))
+        else:
+            # start_response is deferred until the body is iterated.
+            recorder.record(api)
+        return result
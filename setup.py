@@ -20,5 +20,5 @@ setup(
     url='https://github.com/eleme/doctor',
     author='WangChao',
     author_email='hit9@ele.me, xiangyu.wang@ele.me',
-    packages=['doctor'],
+    packages=['doctor', 'doctor.plugins'],
 )
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from doctor import HealthTester, Configs
+from doctor.checker import MODE_LOCKED
+from doctor.aggregator import (Aggregator, AggregatorClient, AggregatorError,
+                               pack_message, unpack_message, TYPE_PUSH)
+
+
+@pytest.fixture(scope='function')
+def configs():
+    configs = Configs()
+    configs.HEALTH_THRESHOLD_REQUEST = 9
+    return configs
+
+
+@pytest.fixture(scope='function', params=['unix', 'udp'])
+def aggregator(request, configs):
+    if request.param == 'unix':
+        tmpdir = tempfile.mkdtemp()
+        request.addfinalizer(lambda: shutil.rmtree(tmpdir))
+        address = os.path.join(tmpdir, 'agg.sock')
+    else:
+        address = ('127.0.0.1', 0)
+    aggregator = Aggregator(address, configs)
+    aggregator.bind()
+    request.addfinalizer(aggregator.close)
+    return aggregator
+
+
+def _client(request, aggregator, configs):
+    tester = HealthTester(configs)
+    client = AggregatorClient(tester, aggregator.address)
+    request.addfinalizer(client.close)
+    return tester, client
+
+
+def _sync(aggregator, *clients):
+    for client in clients:
+        assert client.flush() == 1
+        assert aggregator.serve_once(timeout=1)
+    for client in clients:
+        assert client.poll() == 1
+
+
+def test_pack_message():
+    data = pack_message(TYPE_PUSH, {'a.b': 1, 'a.b.timeout': 2}, ['a.b'])
+    assert unpack_message(data) == (TYPE_PUSH, {'a.b': 1, 'a.b.timeout': 2},
+                                    ['a.b'])
+    assert unpack_message(pack_message(TYPE_PUSH, {}, [])) == \
+        (TYPE_PUSH, {}, [])
+    with pytest.raises(AggregatorError):
+        unpack_message(b'XXXX')
+
+
+def test_merged_metrics(request, aggregator, configs):
+    """Errors spread over processes, each under THRESHOLD_REQUEST, LOCK
+    after merged."""
+    a, client_a = _client(request, aggregator, configs)
+    b, client_b = _client(request, aggregator, configs)
+    for tester in (a, b):
+        for i in range(6):
+            tester.metrics.on_api_called('hello', 'world')
+            tester.metrics.on_api_called_sys_exc('hello', 'world')
+        assert tester.is_healthy('hello', 'world')
+
+    _sync(aggregator, client_a, client_b)
+    _sync(aggregator, client_a)
+
+    assert a.metrics.get('hello.world') == 12
+    assert b.metrics.get('hello.world.sys_exc') == 12
+    b.metrics.on_api_called('hello', 'world')
+    assert b.metrics.get('hello.world') == 13
+    assert not b.test('hello', 'world')
+
+
+def test_remote_locks(request, aggregator, configs):
+    """Api locked in a process, LOCK in others, but not echoed back."""
+    a, client_a = _client(request, aggregator, configs)
+    b, client_b = _client(request, aggregator, configs)
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        a.metrics.on_api_called('hello', 'world')
+        a.metrics.on_api_called_timeout('hello', 'world')
+    assert not a.test('hello', 'world')
+
+    _sync(aggregator, client_a, client_b)
+
+    assert 'hello.world' in b.metrics.remote_locks
+    assert 'hello.world' not in a.metrics.remote_locks
+    assert not b.test('hello', 'world')
+    assert b.locks['hello.world']['locked_status'] == MODE_LOCKED
+    # adopted locks are not pushed again.
+    assert b.locally_locked_keys() == []
+
+
+def test_fail_open(request, aggregator, configs):
+    tester, client = _client(request, aggregator, configs)
+    client.ttl = 0
+    tester.metrics.on_api_called('hello', 'world')
+    _sync(aggregator, client)
+    aggregator.close()
+
+    tester.metrics.on_api_called('hello', 'world')
+    client.flush()
+    assert client.poll() == 0
+    assert tester.metrics.get('hello.world') == 2
+    assert not tester.metrics._remote
+
+
+def test_bad_message(aggregator):
+    client = AggregatorClient(HealthTester(Configs()), aggregator.address)
+    try:
+        client._socket().sendto(b'XXXXXXXX', aggregator.address)
+        assert aggregator.serve_once(timeout=1)
+        assert client.poll() == 0
+    finally:
+        client.close()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import socket
+
+import mock
+import pytest
+
+from doctor.plugins.archer import Doctor
+
+
+class Failure(Exception):
+    pass
+
+
+class SysError(Exception):
+    pass
+
+
+@pytest.fixture(scope='function')
+def doctor():
+    doctor = Doctor(Failure, outcomes={'sys_exc': SysError})
+    doctor.init_app(mock.Mock(service_name='hello'))
+    return doctor
+
+
+def _call(doctor, error=None):
+    api_meta = mock.Mock(app=doctor.app)
+    api_meta.name = 'world'
+    doctor.test(api_meta)
+    doctor.collect_api_call_result(api_meta, mock.Mock(error=error))
+
+
+def test_collect_api_call_result(doctor):
+    metrics = doctor.tester.metrics
+
+    _call(doctor)
+    _call(doctor, SysError())
+    _call(doctor, ValueError())
+    assert metrics.get('hello.world') == 3
+    assert metrics.get('hello.world.sys_exc') == 1
+    assert metrics.get('hello.world.unkwn_exc') == 1
+
+
+def test_default_outcomes():
+    doctor = Doctor(Failure)
+    doctor.init_app(mock.Mock(service_name='hello'))
+
+    _call(doctor, socket.timeout())
+    assert doctor.tester.metrics.get('hello.world.timeout') == 1
+
+
+def test_failure_exception(doctor):
+    for i in range(doctor.configs.HEALTH_THRESHOLD_REQUEST + 1):
+        _call(doctor, SysError())
+
+    with pytest.raises(Failure):
+        _call(doctor)
+
+
+def test_classifier():
+    doctor = Doctor(Failure, outcomes={'sys_exc': SysError})
+    assert doctor.classifier.classify(SysError()) == 'sys_exc'
+    assert doctor.classifier.classify(socket.timeout()) == 'unkwn_exc'
+
+    doctor.init_app(mock.Mock(service_name='hello'))
+    assert doctor.recorder.classifier is doctor.classifier
+
+
+def test_test_uses_cached_handle(doctor):
+    _call(doctor)
+    with mock.patch.object(doctor.tester.metrics, 'api') as api:
+        _call(doctor)
+    assert not api.called
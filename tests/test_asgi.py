@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from doctor import HealthTester, Configs
+from doctor.plugins.asgi import DoctorASGIMiddleware, path_func_name
+
+
+class SysError(Exception):
+    pass
+
+
+def _make_app(status=200, error=None):
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope)
+        if error is not None:
+            raise error
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': []})
+        await send({'type': 'http.response.body', 'body': b'hello'})
+    app.calls = calls
+    return app
+
+
+def _route(scope):
+    return 'hello'
+
+
+@pytest.fixture(scope='function')
+def configs():
+    return Configs()
+
+
+@pytest.fixture(scope='function')
+def tester(configs):
+    return HealthTester(configs)
+
+
+def _get(middleware, path='/hello'):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path}
+    asyncio.run(middleware(scope, receive, send))
+    return messages
+
+
+def test_ok(tester):
+    middleware = DoctorASGIMiddleware(_make_app(), tester, 'svc', _route)
+
+    messages = _get(middleware)
+    assert messages[0]['status'] == 200
+    assert messages[1]['body'] == b'hello'
+    assert tester.metrics.get('svc.hello') == 1
+    assert tester.metrics.api_latest_state['svc.hello']
+
+
+def test_path_func_name(tester):
+    middleware = DoctorASGIMiddleware(_make_app(), tester, 'svc',
+                                      func_name=path_func_name)
+    _get(middleware)
+    assert tester.metrics.get('svc./hello') == 1
+
+
+def test_record_status_and_errors(tester):
+    middleware = DoctorASGIMiddleware(_make_app(500), tester, 'svc', _route)
+    _get(middleware)
+    assert tester.metrics.get('svc.hello.sys_exc') == 1
+
+    middleware = DoctorASGIMiddleware(_make_app(error=SysError()), tester,
+                                      'svc', _route,
+                                      classifier={'timeout': SysError})
+    with pytest.raises(SysError):
+        _get(middleware)
+    assert tester.metrics.get('svc.hello.timeout') == 1
+
+
+def test_reject_without_entering_app(configs, tester):
+    app = _make_app()
+    middleware = DoctorASGIMiddleware(app, tester, 'svc', _route)
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        tester.metrics.on_api_called('svc', 'hello')
+        tester.metrics.on_api_called_sys_exc('svc', 'hello')
+
+    messages = _get(middleware)
+    assert messages[0]['status'] == 503
+    assert not app.calls
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import time
+import random
 
 import mock
 import pytest
 
 from doctor import HealthTester, Configs
 from doctor.checker import MODE_LOCKED, MODE_UNLOCKED, MODE_RECOVER
+from doctor.metrics import HEALTHY_FOREVER
 
 
 @pytest.fixture(scope='function')
@@ -292,3 +294,498 @@ def test_max_recovery_time_passed_latest_state_ok(configs, key,
     assert f_tested.called
     assert f_tested_ok.called
     assert not f_tested_bad.called
+
+
+def test_consecutive_failures_over_threshold(configs, key,
+                                             f_locked, f_unlocked,
+                                             f_tested, f_tested_bad,
+                                             f_tested_ok):
+    """Failed THRESHOLD_CONSECUTIVE_FAILURES times in a row, even requests
+    are not enough for a health check, LOCK."""
+    configs.HEALTH_THRESHOLD_CONSECUTIVE_FAILURES = 3
+    tester = HealthTester(configs, f_locked, f_unlocked,
+                          f_tested, f_tested_bad, f_tested_ok)
+
+    for i in range(2):
+        tester.metrics.on_api_called(*key)
+        tester.metrics.on_api_called_timeout(*key)
+    assert tester.test(*key)
+
+    tester.metrics.on_api_called(*key)
+    tester.metrics.on_api_called_sys_exc(*key)
+
+    assert tester.is_healthy(*key)
+    assert tester.is_failing_in_a_row(*key)
+    assert not tester.test(*key)
+    assert tester.locks['.'.join(key)]['locked_status'] == MODE_LOCKED
+    assert f_locked.called
+    assert f_tested_bad.called
+
+
+def test_consecutive_failures_reset_by_ok(configs, key):
+    """Failures interrupted by a success do not LOCK."""
+    configs.HEALTH_THRESHOLD_CONSECUTIVE_FAILURES = 2
+    tester = HealthTester(configs)
+
+    tester.metrics.on_api_called_timeout(*key)
+    tester.metrics.on_api_called_ok(*key)
+    tester.metrics.on_api_called_timeout(*key)
+
+    assert not tester.is_failing_in_a_row(*key)
+    assert tester.test(*key)
+
+
+def test_consecutive_failures_disabled(configs, key):
+    """THRESHOLD_CONSECUTIVE_FAILURES is 0, never LOCK by failures in
+    a row."""
+    tester = HealthTester(configs)
+
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST):
+        tester.metrics.on_api_called_timeout(*key)
+
+    assert not tester.is_failing_in_a_row(*key)
+    assert tester.test(*key)
+
+
+def test_in_recover_still_failing_in_a_row(configs, key):
+    """In RECOVER, the released request timed out, RECOVER -> LOCK."""
+    configs.HEALTH_THRESHOLD_CONSECUTIVE_FAILURES = 2
+    tester = HealthTester(configs)
+    lock = _set_lock_mode(tester, key, MODE_RECOVER)
+
+    tester.metrics.on_api_called_ok(*key)
+    for i in range(2):
+        tester.metrics.on_api_called_timeout(*key)
+
+    assert tester.metrics.api_latest_state['.'.join(key)]
+    assert not tester.test(*key)
+    assert lock['locked_status'] == MODE_LOCKED
+
+
+def _reference_is_healthy(tester, configs, key):
+    key = '.'.join(key)
+    requests = tester.metrics.get(key)
+    timeouts = tester.metrics.get(key + '.timeout')
+    sys_excs = tester.metrics.get(key + '.sys_exc')
+    unkwn_excs = tester.metrics.get(key + '.unkwn_exc')
+    if requests > configs.HEALTH_THRESHOLD_REQUEST:
+        return (timeouts / float(requests) <
+                configs.HEALTH_THRESHOLD_TIMEOUT and
+                sys_excs / float(requests) <
+                configs.HEALTH_THRESHOLD_SYS_EXC and
+                unkwn_excs / float(requests) <
+                configs.HEALTH_THRESHOLD_UNKWN_EXC)
+    return True
+
+
+def _run_random_calls(configs, seed, no_cache=False, cached=None):
+    rand = random.Random(seed)
+    clock = [1000.0]
+    keys = [('hello', 'world'), ('hello', 'doctor')]
+    hooks = ['on_api_called_ok', 'on_api_called_user_exc',
+             'on_api_called_timeout', 'on_api_called_sys_exc',
+             'on_api_called_unkwn_exc']
+    weights = [20, 2, 3, 3, 2]
+    results = []
+    with mock.patch('time.time', lambda: clock[0]), \
+            mock.patch('random.random', rand.random):
+        tester = HealthTester(configs)
+        for i in range(3000):
+            clock[0] += rand.random() * 0.3
+            key = rand.choice(keys)
+            if no_cache:
+                tester.metrics.healthy_apis.clear()
+            assert tester.is_healthy(*key) == \
+                _reference_is_healthy(tester, configs, key)
+            expires_at = tester.metrics.healthy_apis.get('.'.join(key), 0)
+            if cached is not None and 0 < expires_at < HEALTHY_FOREVER:
+                # healthy verdict cached with errors in the window.
+                cached.append(key)
+            result = tester.test(*key)
+            results.append(result)
+            if not result:
+                continue
+            tester.metrics.on_api_called(*key)
+            hook = rand.choice(sum([[h] * w for h, w in
+                                    zip(hooks, weights)], []))
+            getattr(tester.metrics, hook)(*key)
+    return results
+
+
+def test_cached_health_verdict_equivalence(configs):
+    """Cached health verdicts make exactly the same decisions."""
+    configs.METRICS_GRANULARITY = 1
+    configs.METRICS_ROLLINGSIZE = 5
+    configs.HEALTH_THRESHOLD_REQUEST = 5
+    configs.HEALTH_MIN_RECOVERY_TIME = 2
+    configs.HEALTH_MAX_RECOVERY_TIME = 6
+    configs.HEALTH_THRESHOLD_TIMEOUT = 0.2
+    configs.HEALTH_THRESHOLD_SYS_EXC = 0.2
+    for seed in range(5):
+        cached = []
+        results = _run_random_calls(configs, seed, cached=cached)
+        assert not all(results)
+        assert cached
+        assert results == _run_random_calls(configs, seed, no_cache=True)
+
+
+def test_cached_health_verdict_with_errors(configs, key):
+    """Verdicts with errors are cached until errors or window shifts."""
+    configs.METRICS_GRANULARITY = 1
+    tester = HealthTester(configs)
+    name = '.'.join(key)
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        tester.metrics.on_api_called(*key)
+        tester.metrics.on_api_called_ok(*key)
+    tester.metrics.on_api_called(*key)
+    tester.metrics.on_api_called_sys_exc(*key)
+
+    assert tester.is_healthy(*key)
+    counter = tester.metrics.counters[name]
+    assert tester.metrics.healthy_apis[name] == counter._clock + 1
+
+    # new ok requests keep the verdict.
+    tester.metrics.on_api_called(*key)
+    tester.metrics.on_api_called_ok(*key)
+    assert name in tester.metrics.healthy_apis
+
+    # expired on the window shift, then checked again.
+    expires_at = tester.metrics.healthy_apis[name]
+    with mock.patch('time.time', return_value=expires_at):
+        assert tester.is_healthy(*key)
+    assert tester.metrics.healthy_apis[name] == expires_at + 1
+
+    tester.metrics.on_api_called(*key)
+    tester.metrics.on_api_called_timeout(*key)
+    assert name not in tester.metrics.healthy_apis
+
+
+def test_cached_health_verdict_invalidated_on_errors(configs, key):
+    """Errors discard the cached verdict."""
+    tester = HealthTester(configs)
+
+    tester.metrics.on_api_called(*key)
+    tester.metrics.on_api_called_ok(*key)
+    assert tester.is_healthy(*key)
+    assert '.'.join(key) in tester.metrics.healthy_apis
+
+    tester.metrics.on_api_called_timeout(*key)
+    assert '.'.join(key) not in tester.metrics.healthy_apis
+    assert tester.is_healthy(*key)
+    assert '.'.join(key) not in tester.metrics.healthy_apis
+
+
+def test_service_breaker_locks_all_apis(configs, f_locked, f_unlocked,
+                                        f_tested, f_tested_bad,
+                                        f_tested_ok):
+    """Errors spread over apis of a service, LOCK the whole service."""
+    configs.HEALTH_SERVICE_BREAKER = True
+    tester = HealthTester(configs, f_locked, f_unlocked,
+                          f_tested, f_tested_bad, f_tested_ok)
+
+    requests = configs.HEALTH_THRESHOLD_REQUEST + 1
+    for i in range(requests):
+        func_name = 'func{0}'.format(i)
+        tester.metrics.on_api_called('hello', func_name)
+        tester.metrics.on_api_called_sys_exc('hello', func_name)
+        assert tester.is_healthy('hello', func_name)
+
+    assert not tester.is_service_healthy('hello')
+    assert not tester.test('hello', 'never_called')
+    assert tester.locks['hello.*']['locked_status'] == MODE_LOCKED
+    assert 'hello.never_called' not in tester.locks
+    assert f_locked.call_args[0][0].func_name == '*'
+    assert f_tested_bad.call_args[0][0].func_name == 'never_called'
+    assert f_tested_bad.call_args[0][0].lock['locked_status'] == MODE_LOCKED
+
+    assert tester.test('world', 'never_called')
+
+
+def test_service_breaker_api_locks_still_apply(configs, key):
+    """Service is OK, but the api itself is not, LOCK the api only."""
+    configs.HEALTH_SERVICE_BREAKER = True
+    tester = HealthTester(configs)
+
+    requests = configs.HEALTH_THRESHOLD_REQUEST + 1
+    for i in range(requests * 2):
+        tester.metrics.on_api_called(key[0], 'other')
+        tester.metrics.on_api_called_ok(key[0], 'other')
+    for i in range(requests):
+        tester.metrics.on_api_called(*key)
+        tester.metrics.on_api_called_timeout(*key)
+
+    assert tester.is_service_healthy(key[0])
+    assert not tester.test(*key)
+    assert tester.locks['.'.join(key)]['locked_status'] == MODE_LOCKED
+    assert tester.locks['hello.*']['locked_status'] == MODE_UNLOCKED
+    assert tester.test(key[0], 'other')
+
+
+def test_service_breaker_disabled(configs, key):
+    """SERVICE_BREAKER is disabled, no service metrics nor locks."""
+    tester = HealthTester(configs)
+
+    tester.metrics.on_api_called(*key)
+    tester.metrics.on_api_called_sys_exc(*key)
+
+    assert tester.test(*key)
+    assert tester.metrics.get('hello.*') == 0
+    assert 'hello.*' not in tester.locks
+
+
+def test_reload(configs, key):
+    """Reloaded thresholds apply at once, metrics and locks are kept."""
+    tester = HealthTester(configs)
+    policy = tester.policy
+
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        tester.metrics.on_api_called(*key)
+        tester.metrics.on_api_called_ok(*key)
+    tester.metrics.on_api_called_timeout(*key)
+    assert tester.test(*key)
+    lock = _set_lock_mode(tester, ('hello', 'locked'), MODE_LOCKED)
+
+    configs.HEALTH_THRESHOLD_TIMEOUT = 0.05
+    configs.METRICS_ROLLINGSIZE = 10
+    tester.reload(configs)
+
+    assert tester.policy is not policy
+    assert tester.policy.threshold_timeout == 0.05
+    assert tester.metrics.get('.'.join(key)) == \
+        configs.HEALTH_THRESHOLD_REQUEST + 1
+    assert not tester.test(*key)
+    assert tester.locks['hello.locked'] is lock
+    assert lock['locked_status'] == MODE_LOCKED
+
+
+def test_reload_clears_cached_verdicts(configs, key):
+    """Error-free apis are not healthy with zero thresholds."""
+    tester = HealthTester(configs)
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        tester.metrics.on_api_called(*key)
+        tester.metrics.on_api_called_ok(*key)
+    assert tester.test(*key)
+
+    configs.HEALTH_THRESHOLD_TIMEOUT = 0
+    tester.reload(configs)
+    assert not tester.is_healthy(*key)
+
+
+def test_reload_clears_cached_verdicts_after_swap(configs):
+    """Verdicts cached by concurrent tests under the old policy are
+    cleared too."""
+    tester = HealthTester(configs)
+    policies = []
+
+    class HealthyApis(dict):
+        def clear(self):
+            policies.append(tester.policy)
+            super(HealthyApis, self).clear()
+
+    tester._healthy_apis = HealthyApis()
+    tester.reload(configs)
+    assert policies == [tester.policy]
+
+
+def test_priority_fraction(configs, key):
+    """Heavier priorities saturate first, the admitted fraction of all
+    requests is kept."""
+    configs.HEALTH_PRIORITY_WEIGHTS = {'critical': 4, 'sheddable': 0.25}
+    tester = HealthTester(configs)
+    tester.metrics.incr('hello.world.priority.critical', 10)
+    tester.metrics.incr('hello.world.priority.default', 10)
+    tester.metrics.incr('hello.world.priority.sheddable', 80)
+
+    fractions = dict((priority, tester.priority_fraction(
+        'hello', 'world', priority, 0.2))
+        for priority in ('critical', None, 'unknown', 'sheddable'))
+    assert fractions['critical'] == 1
+    assert abs(fractions[None] - 1 / 3.0) < 1e-9
+    assert fractions['unknown'] == fractions[None]
+    assert abs(fractions['sheddable'] - 1 / 12.0) < 1e-9
+    admitted = 10 * fractions['critical'] + 10 * fractions[None] + \
+        80 * fractions['sheddable']
+    assert abs(admitted - 20) < 1e-9
+
+    assert tester.priority_fraction('hello', 'other', 'critical', 0.2) == 0.2
+
+
+def test_priority_in_recover(configs, key):
+    """In RECOVER, heavier priorities are admitted more at equal load."""
+    configs.HEALTH_MAX_RECOVERY_TIME = 100
+    configs.HEALTH_PRIORITY_WEIGHTS = {'critical': 8, 'sheddable': 0.25}
+    tester = HealthTester(configs)
+    lock = _set_lock_mode(tester, key, MODE_RECOVER)
+    lock['locked_at'] = time.time() - 20
+    tester.metrics.on_api_called_ok(*key)
+
+    random.seed(1)
+    admitted = dict(critical=0, sheddable=0)
+    for i in range(2000):
+        for priority in ('critical', 'sheddable', 'sheddable', 'sheddable'):
+            admitted[priority] += tester.test(*key, priority=priority)
+    assert lock['locked_status'] == MODE_RECOVER
+    # 0.2 of each without priorities.
+    assert admitted['critical'] > 2000 * 0.6
+    assert admitted['sheddable'] < 6000 * 0.05
+    total = admitted['critical'] + admitted['sheddable']
+    assert abs(total / 8000.0 - 0.2) < 0.02
+    assert tester.metrics.get('hello.world.priority.critical') == 2000
+
+
+def test_priority_disabled(configs, key, f_tested):
+    """PRIORITY_WEIGHTS is empty, priorities are not counted."""
+    tester = HealthTester(configs, on_api_health_tested=f_tested)
+    _set_lock_mode(tester, key, MODE_RECOVER)
+    tester.metrics.on_api_called_ok(*key)
+
+    tester.test(*key, priority='critical')
+    assert f_tested.call_args[0][0].priority == 'critical'
+    assert tester.metrics.get('hello.world.priority.critical') == 0
+
+
+def test_priority_degraded(configs, key):
+    """Errors over DEGRADED_RATIO of thresholds, shed light requests, but
+    still UNLOCK."""
+    configs.HEALTH_PRIORITY_WEIGHTS = {'critical': 4, 'sheddable': 0}
+    configs.HEALTH_DEGRADED_RATIO = 0.5
+    tester = HealthTester(configs)
+
+    requests = configs.HEALTH_THRESHOLD_REQUEST + 1
+    for i in range(requests):
+        tester.metrics.on_api_called(*key)
+        tester.metrics.on_api_called_ok(*key)
+    assert tester.test(*key, priority='sheddable')
+
+    for i in range(requests // 3):
+        tester.metrics.on_api_called_timeout(*key)
+
+    assert tester.is_healthy(*key)
+    assert tester.test(*key, priority='critical')
+    assert tester.test(*key)
+    assert not tester.test(*key, priority='sheddable')
+    assert tester.locks['.'.join(key)]['locked_status'] == MODE_UNLOCKED
+
+
+def test_can_retry(configs, key):
+    configs.HEALTH_RETRY_BUDGET_RATIO = 0.2
+    configs.HEALTH_RETRY_BUDGET_MIN = 2
+    tester = HealthTester(configs)
+
+    # always allowed under the min retries.
+    for i in range(2):
+        assert tester.can_retry(*key)
+        tester.metrics.on_api_called(*key, retry=True)
+    assert not tester.can_retry(*key)
+
+    for i in range(8):
+        tester.metrics.on_api_called(*key)
+    # 2 retries in 10 requests.
+    assert not tester.can_retry(*key)
+    tester.metrics.on_api_called(*key)
+    assert tester.can_retry(*key)
+
+
+def test_can_retry_disabled(configs, key):
+    tester = HealthTester(configs)
+    for i in range(10):
+        tester.metrics.on_api_called(*key, retry=True)
+    assert tester.can_retry(*key)
+
+
+def test_stats(configs, key):
+    configs.HEALTH_STATS_SAMPLING = 2
+    configs.HEALTH_MIN_RECOVERY_TIME = 0
+    tester = HealthTester(configs)
+
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        assert tester.test(*key)
+        tester.metrics.on_api_called(*key)
+        tester.metrics.on_api_called_sys_exc(*key)
+    # turns BAD, then stays locked.
+    assert not tester.test(*key)
+    assert not tester.test(*key)
+    # sampled on the 2nd call.
+    assert tester.is_healthy(*key) is False
+    assert tester.is_healthy(*key) is False
+
+    snapshot = tester.stats.snapshot()
+    assert snapshot['sampling'] == 2
+    assert snapshot['decisions']['unlocked'] == {
+        'allowed': configs.HEALTH_THRESHOLD_REQUEST + 1, 'rejected': 1}
+    assert snapshot['decisions']['locked'] == {'rejected': 1}
+    timings = snapshot['timings']
+    assert timings['test']['count'] == 6
+    assert timings['is_healthy']['count'] == 7
+    assert timings['callbacks']['count'] == 6
+    assert timings['test']['max'] >= timings['test']['mean'] > 0
+
+    tester.stats.reset()
+    assert tester.stats.snapshot()['decisions']['unlocked'] == {}
+
+
+def test_stats_probe(configs, key):
+    configs.HEALTH_STATS_SAMPLING = 1
+    configs.HEALTH_MIN_RECOVERY_TIME = 0
+    tester = HealthTester(configs)
+    tester.locks['.'.join(key)]['locked_status'] = MODE_LOCKED
+    tester.locks['.'.join(key)]['locked_at'] = time.time()
+
+    assert tester.test(*key)
+    assert tester.stats.snapshot()['decisions']['locked'] == {'probe': 1}
+
+
+def test_stats_window_shifts():
+    configs = Configs({'METRICS_GRANULARITY': 1, 'HEALTH_STATS_SAMPLING': 1})
+    tester = HealthTester(configs)
+    tester.metrics.on_api_called('hello', 'world')
+    counter = tester.metrics.counters['hello.world']
+    counter.shift_on_clock_changes(counter._clock + 3)
+    assert tester.stats.snapshot()['window_shifts'] == 1
+
+    # shifts of other testers are not counted.
+    other = HealthTester(configs)
+    other.metrics.on_api_called('hello', 'world')
+    counter = other.metrics.counters['hello.world']
+    counter.shift_on_clock_changes(counter._clock + 3)
+    assert tester.stats.snapshot()['window_shifts'] == 1
+
+
+def test_stats_disabled(configs, key):
+    tester = HealthTester(configs)
+    assert tester.stats is None
+    configs.HEALTH_STATS_SAMPLING = 10
+    tester.reload(configs)
+    assert tester.stats.sampling == 10
+    configs.HEALTH_STATS_SAMPLING = 0
+    tester.reload(configs)
+    assert tester.stats is None
+
+
+def test_locally_locked_keys(configs, key):
+    tester = HealthTester(configs)
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        tester.metrics.on_api_called(*key)
+        tester.metrics.on_api_called_sys_exc(*key)
+    assert not tester.test(*key)
+    tester.metrics.on_api_called('hello', 'ok')
+    tester.metrics.on_api_called_ok('hello', 'ok')
+    tester.locks['hello.ok']['locked_status'] = MODE_LOCKED
+
+    tester.metrics.healthy_apis.clear()
+    assert tester.locally_locked_keys() == ['.'.join(key)]
+    # no verdicts cached by the checks.
+    assert not tester.metrics.healthy_apis
+
+
+def test_record_batch_with_consecutive_failures(configs, key):
+    """A mixed batch does not lock by a made-up failure streak."""
+    configs.HEALTH_THRESHOLD_CONSECUTIVE_FAILURES = 3
+    tester = HealthTester(configs)
+    tester.metrics.record_batch(*key, ok=97, timeout=3)
+    assert not tester.is_failing_in_a_row(*key)
+    assert tester.test(*key)
+
+    tester.metrics.record_batch(*key, timeout=3)
+    assert tester.is_failing_in_a_row(*key)
+    assert not tester.test(*key)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import mock
+import pytest
+
+from doctor import HealthTester, Configs
+from doctor.checker import MODE_LOCKED
+from doctor.checkpoint import Checkpoint, CheckpointError
+
+
+@pytest.fixture(scope='function')
+def configs():
+    configs = Configs()
+    configs.METRICS_GRANULARITY = 1
+    configs.METRICS_ROLLINGSIZE = 10
+    configs.HEALTH_MIN_RECOVERY_TIME = 20
+    return configs
+
+
+@pytest.fixture(scope='function')
+def path(tmpdir):
+    return str(tmpdir.join('checkpoint'))
+
+
+def _locked_tester(configs):
+    tester = HealthTester(configs)
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        tester.metrics.on_api_called('hello', 'world')
+        tester.metrics.on_api_called_sys_exc('hello', 'world')
+    tester.metrics.on_api_called('hello', 'ok')
+    tester.metrics.on_api_called_ok('hello', 'ok')
+    assert not tester.test('hello', 'world')
+    return tester
+
+
+def test_save_restore(configs, path):
+    tester = _locked_tester(configs)
+    Checkpoint(tester, path).save()
+
+    restored = HealthTester(configs)
+    assert Checkpoint(restored, path).restore()
+
+    assert restored.locks['hello.world']['locked_status'] == MODE_LOCKED
+    assert restored.locks['hello.world']['locked_at'] == \
+        tester.locks['hello.world']['locked_at']
+    assert 'hello.ok' not in restored.locks
+    assert restored.metrics.get('hello.world.sys_exc') == \
+        configs.HEALTH_THRESHOLD_REQUEST + 1
+    assert restored.metrics.api_latest_state == \
+        tester.metrics.api_latest_state
+    assert restored.metrics.api_failure_streak == \
+        tester.metrics.api_failure_streak
+    assert not restored.test('hello', 'world')
+    assert restored.test('hello', 'ok')
+
+
+def test_restore_shifts_by_elapsed_time(configs, path):
+    tester = _locked_tester(configs)
+    Checkpoint(tester, path).save()
+
+    now = time.time()
+    restored = HealthTester(configs)
+    Checkpoint(restored, path).restore()
+    with mock.patch('time.time', lambda: now + 3):
+        counter = restored.metrics._counter('hello.world')
+        assert counter._values[-4] == configs.HEALTH_THRESHOLD_REQUEST + 1
+        assert counter._values[-3:] == [0, 0, 0]
+
+    restored = HealthTester(configs)
+    Checkpoint(restored, path).restore()
+    with mock.patch('time.time', lambda: now + 11):
+        assert restored.metrics.get('hello.world') == 0
+        assert restored.test('hello', 'world') is False
+
+
+def test_restore_in_place_and_resize(configs, path):
+    tester = _locked_tester(configs)
+    Checkpoint(tester, path).save()
+
+    configs.METRICS_ROLLINGSIZE = 5
+    restored = HealthTester(configs)
+    api = restored.metrics.api('hello', 'world')
+    counter = restored.metrics.counters['hello.world']
+    Checkpoint(restored, path).restore()
+
+    assert restored.metrics.counters['hello.world'] is counter
+    assert len(counter._values) == 5
+    api.record('ok')
+    assert restored.metrics.get('hello.world') == \
+        configs.HEALTH_THRESHOLD_REQUEST + 2
+
+
+def test_dumps_keeps_lazily_restored_counters(configs, path):
+    tester = _locked_tester(configs)
+    Checkpoint(tester, path).save()
+
+    restored = HealthTester(configs)
+    checkpoint = Checkpoint(restored, path)
+    checkpoint.restore()
+    assert 'hello.ok' not in restored.metrics.counters
+    checkpoint.save()
+
+    again = HealthTester(configs)
+    Checkpoint(again, path).restore()
+    assert again.metrics.get('hello.ok') == 1
+    assert again.metrics.get('hello.world') == \
+        configs.HEALTH_THRESHOLD_REQUEST + 1
+
+
+def test_restore_errors(configs, path):
+    tester = HealthTester(configs)
+    checkpoint = Checkpoint(tester, path)
+    assert not checkpoint.restore()
+
+    with open(path, 'wb') as f:
+        f.write(b'XXXX' + b'\0' * 20)
+    with pytest.raises(CheckpointError):
+        checkpoint.loads(open(path, 'rb').read())
+    assert not checkpoint.restore()
+
+    # empty, then truncated files fall back to a cold start.
+    open(path, 'wb').close()
+    assert not checkpoint.restore()
+    data = Checkpoint(_locked_tester(configs), path).dumps()
+    for size in (10, len(data) // 2, len(data) - 1):
+        with open(path, 'wb') as f:
+            f.write(data[:size])
+        assert not checkpoint.restore()
+    assert not tester.locks
+    assert not tester.metrics.api_latest_state
+
+
+def test_save_unique_temporary_file(configs, path, tmpdir):
+    tester = _locked_tester(configs)
+    with mock.patch('os.rename') as rename, mock.patch('os.fsync') as fsync:
+        Checkpoint(tester, path).save()
+        Checkpoint(tester, path).save()
+    assert fsync.call_count == 2
+    tmp_paths = [call[0][0] for call in rename.call_args_list]
+    assert tmp_paths[0] != tmp_paths[1]
+    assert all(call[0][1] == path for call in rename.call_args_list)
+    assert all(os.path.dirname(p) == str(tmpdir) for p in tmp_paths)
+
+
+def test_start_stop(configs, path):
+    tester = _locked_tester(configs)
+    checkpoint = Checkpoint(tester, path, interval=0.01)
+    checkpoint.start()
+    with pytest.raises(RuntimeError):
+        checkpoint.start()
+    time.sleep(0.05)
+    checkpoint.stop(save=False)
+
+    restored = HealthTester(configs)
+    assert Checkpoint(restored, path).restore()
+    assert restored.locks['hello.world']['locked_status'] == MODE_LOCKED
+    assert 'hello.ok' not in restored.locks
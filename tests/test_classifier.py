@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from doctor import ExceptionClassifier
+from doctor.metrics import (OUTCOME_OK, OUTCOME_USER_EXC, OUTCOME_TIMEOUT,
+                            OUTCOME_SYS_EXC, OUTCOME_UNKWN_EXC)
+
+
+class UserError(Exception):
+    pass
+
+
+class SysError(Exception):
+    pass
+
+
+class DBError(SysError):
+    pass
+
+
+class DBTimeout(DBError):
+    pass
+
+
+@pytest.fixture(scope='function')
+def classifier():
+    return ExceptionClassifier({
+        OUTCOME_USER_EXC: UserError,
+        OUTCOME_SYS_EXC: [SysError],
+        OUTCOME_TIMEOUT: (DBTimeout, IOError),
+    })
+
+
+def test_classify(classifier):
+    assert classifier.classify(None) == OUTCOME_OK
+    assert classifier.classify(UserError()) == OUTCOME_USER_EXC
+    assert classifier.classify(SysError()) == OUTCOME_SYS_EXC
+    assert classifier.classify(DBTimeout()) == OUTCOME_TIMEOUT
+    assert classifier.classify(ValueError()) == OUTCOME_UNKWN_EXC
+
+
+def test_classify_by_mro(classifier):
+    """Nearest base class wins, and the result is cached."""
+    assert DBError not in classifier._cache
+    assert classifier.classify(DBError()) == OUTCOME_SYS_EXC
+    assert classifier._cache[DBError] == OUTCOME_SYS_EXC
+    assert classifier.classify(DBError) == OUTCOME_SYS_EXC
+
+
+def test_classify_default():
+    classifier = ExceptionClassifier(default=OUTCOME_SYS_EXC)
+    assert classifier.classify(ValueError()) == OUTCOME_SYS_EXC
+
+
+def test_unknown_outcome():
+    with pytest.raises(ValueError):
+        ExceptionClassifier({'oops': ValueError})
+
+
+def test_match(classifier):
+    assert classifier.match(DBTimeout()) == OUTCOME_TIMEOUT
+    assert classifier.match(DBError) == OUTCOME_SYS_EXC
+    assert classifier.match(ValueError()) is None
+    assert classifier.match(KeyboardInterrupt()) is None
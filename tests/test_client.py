@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import mock
+import pytest
+
+from doctor import HealthTester, Configs
+from doctor.fallback import FallbackCache
+from doctor.plugins.client import api_call
+
+
+class SysError(Exception):
+    pass
+
+
+class Timeout(BaseException):
+    """Like ``gevent.Timeout``, not an ``Exception``."""
+
+
+@pytest.fixture(scope='function')
+def configs():
+    return Configs()
+
+
+@pytest.fixture(scope='function')
+def tester(configs):
+    return HealthTester(configs)
+
+
+def _lock(configs, tester, func_name):
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        tester.metrics.on_api_called('svc', func_name)
+        tester.metrics.on_api_called_sys_exc('svc', func_name)
+
+
+def test_api_call(tester):
+    @api_call(tester, 'svc', classifier={'sys_exc': SysError})
+    def hello(fail=False):
+        if fail:
+            raise SysError()
+        return 'hello'
+
+    assert hello() == 'hello'
+    with pytest.raises(SysError):
+        hello(fail=True)
+    assert hello.__name__ == 'hello'
+    assert tester.metrics.get('svc.hello') == 2
+    assert tester.metrics.get('svc.hello.sys_exc') == 1
+
+
+def test_api_call_base_exception_timeout(configs, tester):
+    @api_call(tester, 'svc', classifier={'timeout': Timeout})
+    def get():
+        raise Timeout()
+
+    requests = configs.HEALTH_THRESHOLD_REQUEST + 1
+    for i in range(requests):
+        with pytest.raises(Timeout):
+            get()
+    assert tester.metrics.get('svc.get') == requests
+    assert tester.metrics.get('svc.get.timeout') == requests
+    assert not tester.test('svc', 'get')
+
+
+def test_api_call_cancelled_not_recorded(tester):
+    @api_call(tester, 'svc')
+    async def get():
+        await asyncio.sleep(1)
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(get(), 0.01)
+
+    asyncio.run(main())
+    assert tester.metrics.get('svc.get') == 0
+    assert tester.metrics.get('svc.get.unkwn_exc') == 0
+    assert 'svc.get' not in tester.metrics.api_latest_state
+
+    @api_call(tester, 'svc')
+    def exit():
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        exit()
+    assert tester.metrics.get('svc.exit') == 0
+
+
+def test_api_call_rejected(configs, tester):
+    calls = []
+
+    @api_call(tester, 'svc', func_name='api',
+              on_rejected=lambda x: 'fallback {0}'.format(x))
+    def hello(x):
+        calls.append(x)
+        return x
+
+    _lock(configs, tester, 'api')
+    assert hello(1) == 'fallback 1'
+    assert not calls
+
+
+def test_api_call_coroutine(configs, tester):
+    @api_call(tester, 'svc', on_rejected=lambda: 'rejected')
+    async def hello(fail=False):
+        if fail:
+            raise SysError()
+        return 'hello'
+
+    assert asyncio.run(hello()) == 'hello'
+    with pytest.raises(SysError):
+        asyncio.run(hello(fail=True))
+    assert tester.metrics.get('svc.hello.unkwn_exc') == 1
+
+    _lock(configs, tester, 'hello')
+    assert asyncio.run(hello()) == 'rejected'
+
+
+def test_api_call_fallback(configs, tester):
+    fallback = FallbackCache()
+
+    @api_call(tester, 'svc', func_name='api', fallback=fallback,
+              on_rejected=lambda x: 'rejected')
+    def hello(x):
+        return 'hello {0}'.format(x)
+
+    assert hello(1) == 'hello 1'
+    _lock(configs, tester, 'api')
+    assert hello(1) == 'hello 1'
+    assert hello(2) == 'rejected'
+    assert fallback.snapshot()['hits'] == 1
+
+
+def test_api_call_fallback_mixed_type_dict_keys(tester):
+    @api_call(tester, 'svc', fallback=FallbackCache())
+    def get(params):
+        return len(params)
+
+    assert get({1: 'a', 'b': 2}) == 2
+
+
+def test_api_call_coroutine_fallback(configs, tester):
+    fallback = FallbackCache()
+
+    @api_call(tester, 'svc', fallback=fallback)
+    async def hello(x):
+        return x
+
+    assert asyncio.run(hello([1])) == [1]
+    _lock(configs, tester, 'hello')
+    assert asyncio.run(hello([1])) == [1]
+    assert asyncio.run(hello([2])) is None
+
+
+def test_api_call_uses_handle(tester):
+    @api_call(tester, 'svc')
+    def hello():
+        return 'hello'
+
+    with mock.patch.object(tester.metrics, 'api') as api:
+        assert hello() == 'hello'
+    assert not api.called
+    assert tester.metrics.get('svc.hello') == 1
@@ -17,6 +17,9 @@ def test_init_with_defaults():
     assert configs['HEALTH_THRESHOLD_TIMEOUT'] == 0.5
     assert configs['HEALTH_THRESHOLD_SYS_EXC'] == 0.5
     assert configs['HEALTH_THRESHOLD_UNKWN_EXC'] == 0.5
+    assert configs['HEALTH_THRESHOLD_CONSECUTIVE_FAILURES'] == 0
+    assert configs['HEALTH_SERVICE_BREAKER'] is False
+    assert configs['HEALTH_RETRY_BUDGET_RATIO'] == 0
 
 
 def test_setattr():
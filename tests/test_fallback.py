@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import mock
+
+from doctor.fallback import FallbackCache
+
+
+def test_fallback_cache():
+    cache = FallbackCache(max_entries=2)
+    key = cache.make_key('svc', 'api', ([1, 2],), {'b': {'x': 1}, 'a': 2})
+    assert key == cache.make_key('svc', 'api', ((1, 2),),
+                                 {'a': 2, 'b': {'x': 1}})
+
+    assert cache.get(key) is None
+    cache.set(key, 'v')
+    assert cache.get(key) == 'v'
+    assert cache.snapshot()['hits'] == 1
+    assert cache.snapshot()['misses'] == 1
+
+
+def test_fallback_cache_unhashable():
+    cache = FallbackCache()
+    assert cache.make_key('svc', 'api', (object(),), {}) is not None
+    assert cache.make_key('svc', 'api', (bytearray(b'x'),), {}) is None
+    assert cache.make_key('svc', 'api', ({'a': [bytearray()]},), {}) is None
+
+
+def test_fallback_cache_mixed_type_dict_keys():
+    cache = FallbackCache()
+    key = cache.make_key('svc', 'api', ({1: 'a', 'b': 2},), {})
+    assert key is not None
+    assert key == cache.make_key('svc', 'api', ({'b': 2, 1: 'a'},), {})
+
+
+def test_fallback_cache_key_func_errors():
+    def key_func(args, kwargs):
+        raise ValueError()
+
+    cache = FallbackCache(key_func=key_func)
+    assert cache.make_key('svc', 'api', (1,), {}) is None
+
+
+def test_fallback_cache_lru():
+    cache = FallbackCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # `b` is the least recently used.
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.snapshot()['evictions'] == 1
+
+
+def test_fallback_cache_ttl():
+    cache = FallbackCache(ttl=10)
+    cache.set('a', 1)
+    with mock.patch('time.time', return_value=cache._entries['a'][0]):
+        assert cache.get('a', 'missing') == 'missing'
+    assert len(cache) == 0
+    assert cache.snapshot()['expirations'] == 1
+
+
+def test_fallback_cache_max_bytes():
+    cache = FallbackCache(max_bytes=10, sizeof=len)
+    cache.set('a', 'x' * 6)
+    cache.set('b', 'x' * 11)
+    assert cache.get('b') is None
+    cache.set('c', 'x' * 4)
+    assert cache.snapshot()['bytes'] == 10
+    cache.set('d', 'x')
+    assert cache.get('a') is None
+    assert cache.snapshot()['bytes'] == 5
@@ -2,6 +2,8 @@
 
 import time
 
+import mock
+
 from doctor.metrics import RollingNumber, Metrics
 from doctor.configs import Configs
 
@@ -45,3 +47,189 @@ def test_metrics():
     metrics.on_api_called_sys_exc('baz', 'foo')
     assert metrics.get('baz.foo.sys_exc') == 1
     assert not metrics.api_latest_state['baz.foo']
+
+
+def test_metrics_failure_streak():
+    metrics = Metrics(Configs())
+
+    metrics.on_api_called_timeout('foo', 'bar')
+    metrics.on_api_called_sys_exc('foo', 'bar')
+    assert metrics.api_failure_streak['foo.bar'] == 2
+
+    metrics.on_api_called_unkwn_exc('foo', 'bar')
+    assert metrics.api_failure_streak['foo.bar'] == 2
+
+    metrics.on_api_called_ok('foo', 'bar')
+    assert metrics.api_failure_streak['foo.bar'] == 0
+
+    metrics.on_api_called_timeout('foo', 'bar')
+    metrics.on_api_called_user_exc('foo', 'bar')
+    assert metrics.api_failure_streak['foo.bar'] == 0
+
+
+def test_metrics_service_aggregated():
+    configs = Configs()
+    configs.HEALTH_SERVICE_BREAKER = True
+    metrics = Metrics(configs)
+
+    metrics.on_api_called('foo', 'bar')
+    metrics.on_api_called('foo', 'baz')
+    metrics.on_api_called_timeout('foo', 'bar')
+    metrics.on_api_called_sys_exc('foo', 'baz')
+    assert metrics.get('foo.*') == 2
+    assert metrics.get('foo.*.timeout') == 1
+    assert metrics.get('foo.*.sys_exc') == 1
+    assert metrics.api_failure_streak['foo.*'] == 2
+    assert not metrics.api_latest_state['foo.*']
+
+    metrics.on_api_called_ok('foo', 'bar')
+    assert metrics.api_latest_state['foo.*']
+    assert not metrics.api_latest_state['foo.baz']
+
+
+def test_metrics_api_handle():
+    metrics = Metrics(Configs())
+
+    api = metrics.api('foo', 'bar')
+    assert metrics.api('foo', 'bar') is api
+    assert api.key == 'foo.bar'
+    assert api.service_key is None
+
+    api.record('ok')
+    api.record('timeout')
+    api.record('sys_exc')
+    assert metrics.get('foo.bar') == 3
+    assert metrics.get('foo.bar.timeout') == 1
+    assert metrics.get('foo.bar.sys_exc') == 1
+    assert metrics.api_failure_streak['foo.bar'] == 2
+    assert not metrics.api_latest_state['foo.bar']
+
+    api.record('user_exc')
+    assert metrics.api_latest_state['foo.bar']
+    assert metrics.api_failure_streak['foo.bar'] == 0
+
+
+def test_rollingnumber_resize():
+    rn = RollingNumber(3, 1)
+    rn._values = [1, 2, 3]
+
+    rn.resize(5)
+    assert rn._values == [0, 0, 1, 2, 3]
+    assert rn.value() == 6
+
+    rn.resize(2, 10)
+    assert rn._values == [2, 3]
+    assert rn.rolling_granularity == 10
+
+
+def test_metrics_reload():
+    metrics = Metrics(Configs())
+    api = metrics.api('foo', 'bar')
+    api.record('timeout')
+
+    configs = Configs({'METRICS_ROLLINGSIZE': 30,
+                       'HEALTH_SERVICE_BREAKER': True})
+    metrics.reload(configs)
+    assert metrics.counters['foo.bar']._values[-1] == 1
+    assert len(metrics.counters['foo.bar']._values) == 30
+    assert metrics.get('foo.bar.timeout') == 1
+
+    api.record('timeout')
+    assert api.service_key == 'foo.*'
+    assert metrics.get('foo.bar.timeout') == 2
+    assert metrics.get('foo.*.timeout') == 1
+
+
+def _record_one_by_one(metrics, counts, order):
+    for outcome in order:
+        for i in range(counts.get(outcome, 0)):
+            metrics.on_api_called('foo', 'bar')
+            getattr(metrics, 'on_api_called_{0}'.format(outcome))('foo', 'bar')
+
+
+def _snapshot(metrics):
+    return dict((key, metrics.get(key)) for key in metrics.counters), \
+        dict(metrics.api_latest_state), dict(metrics.api_failure_streak)
+
+
+def test_metrics_record_batch():
+    """Batches with `last` are replayed in order, failures last."""
+    order = ['ok', 'user_exc', 'unkwn_exc', 'timeout', 'sys_exc']
+    for counts, last in [
+            ({'ok': 3, 'timeout': 2}, 'timeout'),
+            ({'ok': 3, 'timeout': 2, 'unkwn_exc': 1}, 'unkwn_exc'),
+            ({'user_exc': 1, 'sys_exc': 2}, 'user_exc'),
+            ({'ok': 2, 'sys_exc': 1, 'timeout': 1}, 'sys_exc'),
+            ({'timeout': 4}, 'timeout')]:
+        configs = Configs({'HEALTH_SERVICE_BREAKER': True})
+        expected = Metrics(configs)
+        expected.on_api_called_timeout('foo', 'bar')
+        _record_one_by_one(expected, counts, sorted(
+            order, key=lambda outcome: outcome == last))
+
+        metrics = Metrics(configs)
+        metrics.on_api_called_timeout('foo', 'bar')
+        metrics.record_batch('foo', 'bar', last=last, **counts)
+        assert _snapshot(metrics) == _snapshot(expected)
+
+
+def test_metrics_record_batch_unordered():
+    """Failures in a batch with successes make no streak."""
+    metrics = Metrics(Configs())
+    metrics.on_api_called_timeout('foo', 'bar')
+    metrics.record_batch('foo', 'bar', ok=97, timeout=3)
+    assert metrics.api_failure_streak['foo.bar'] == 0
+    assert metrics.api_latest_state['foo.bar']
+
+    metrics.record_batch('foo', 'bar', ok=99, sys_exc=1)
+    assert metrics.api_latest_state['foo.bar']
+
+    # failed as a whole.
+    metrics.record_batch('foo', 'bar', timeout=2)
+    assert metrics.api_failure_streak['foo.bar'] == 2
+    assert metrics.api_latest_state['foo.bar']
+    metrics.record_batch('foo', 'bar', sys_exc=1, unkwn_exc=1)
+    assert metrics.api_failure_streak['foo.bar'] == 3
+    assert not metrics.api_latest_state['foo.bar']
+
+
+def test_metrics_record_batches():
+    metrics = Metrics(Configs())
+    with mock.patch('time.time', mock.Mock(return_value=1000.0)) as clock:
+        metrics.api('foo', 'bar')
+        metrics.api('foo', 'baz')
+        clock.reset_mock()
+        metrics.record_batches([
+            ('foo', 'bar', {'ok': 10, 'sys_exc': 1}),
+            ('foo', 'baz', {'timeout': 2, 'last': 'timeout'}),
+        ])
+        assert clock.call_count == 1
+        assert metrics.get('foo.bar') == 11
+        assert metrics.get('foo.bar.sys_exc') == 1
+        assert metrics.get('foo.baz.timeout') == 2
+    assert metrics.api_latest_state['foo.bar']
+    assert metrics.api_failure_streak['foo.baz'] == 2
+
+
+def test_rollingnumber_running_sum():
+    rn = RollingNumber(4, 1)
+    now = rn._clock
+    for i in range(40):
+        rn.incr(i % 3, now + i * 0.7)
+        assert rn._sum == sum(rn._values)
+    rn.shift_on_clock_changes(now + 100)
+    assert rn._sum == 0
+    rn.resize(2)
+    assert rn._sum == sum(rn._values)
+
+
+def test_metrics_retry():
+    metrics = Metrics(Configs({'HEALTH_SERVICE_BREAKER': True}))
+    metrics.on_api_called('foo', 'bar')
+    metrics.on_api_called('foo', 'bar', retry=True)
+    metrics.api('foo', 'bar').record('sys_exc', retry=True)
+    metrics.record_batch('foo', 'bar', ok=3, retries=2)
+
+    assert metrics.get('foo.bar') == 6
+    assert metrics.get('foo.bar.retry') == 4
+    assert metrics.get('foo.*.retry') == 4
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+
+from doctor import HealthTester, Configs
+from doctor.plugins.wsgi import DoctorMiddleware, path_func_name
+
+
+class SysError(Exception):
+    pass
+
+
+class Timeout(BaseException):
+    pass
+
+
+def _make_app(status='200 OK', error=None):
+    def app(environ, start_response):
+        if error is not None:
+            raise error
+        start_response(status, [])
+        return [b'hello']
+    return mock.Mock(side_effect=app)
+
+
+def _route(environ):
+    return 'hello'
+
+
+@pytest.fixture(scope='function')
+def configs():
+    return Configs()
+
+
+@pytest.fixture(scope='function')
+def tester(configs):
+    return HealthTester(configs)
+
+
+def _get(middleware, path='/hello'):
+    start_response = mock.Mock()
+    body = middleware({'REQUEST_METHOD': 'GET', 'PATH_INFO': path},
+                      start_response)
+    return start_response.call_args[0][0], body
+
+
+def test_ok(tester):
+    app = _make_app()
+    middleware = DoctorMiddleware(app, tester, 'svc', _route)
+
+    assert _get(middleware) == ('200 OK', [b'hello'])
+    assert tester.metrics.get('svc.hello') == 1
+    assert tester.metrics.api_latest_state['svc.hello']
+
+
+def test_path_func_name(tester):
+    middleware = DoctorMiddleware(_make_app(), tester, 'svc',
+                                  func_name=path_func_name)
+    _get(middleware)
+    assert tester.metrics.get('svc./hello') == 1
+
+
+def test_record_status_and_errors(tester):
+    middleware = DoctorMiddleware(_make_app('502 Bad Gateway'), tester, 'svc',
+                                  func_name=lambda environ: 'api')
+    _get(middleware)
+    assert tester.metrics.get('svc.api.sys_exc') == 1
+
+    middleware = DoctorMiddleware(_make_app(error=SysError()), tester, 'svc',
+                                  func_name=lambda environ: 'api',
+                                  classifier={'timeout': SysError})
+    with pytest.raises(SysError):
+        _get(middleware)
+    assert tester.metrics.get('svc.api.timeout') == 1
+    assert tester.metrics.get('svc.api') == 2
+
+
+def test_reject_without_entering_app(configs, tester):
+    app = _make_app()
+    middleware = DoctorMiddleware(app, tester, 'svc', _route,
+                                  reject_body=b'busy')
+    for i in range(configs.HEALTH_THRESHOLD_REQUEST + 1):
+        tester.metrics.on_api_called('svc', 'hello')
+        tester.metrics.on_api_called_sys_exc('svc', 'hello')
+
+    status, body = _get(middleware)
+    assert status == '503 Service Unavailable'
+    assert body == [b'busy']
+    assert not app.called
+
+
+def test_record_base_exception(tester):
+    middleware = DoctorMiddleware(_make_app(error=Timeout()), tester, 'svc',
+                                  func_name=lambda environ: 'api',
+                                  classifier={'timeout': Timeout})
+    with pytest.raises(Timeout):
+        _get(middleware)
+    assert tester.metrics.get('svc.api.timeout') == 1